@@ -9,81 +9,674 @@
 # ----------------------
 
 import subprocess
+import shutil
 import json
+import re
+import sys
+import os
+import time
+import datetime
+import concurrent.futures
+import threading
+import queue
+import codecs
+import tempfile
 
-def get_instances(region = ""):
-	cmd = "aws ec2 describe-instances --output json"
+# Region used to look up the list of regions if no default region is configured
+DEFAULT_REGION = "us-east-1"
+
+# The only instance fields used to create connections. The AWS CLI drops all other fields
+# (block devices, network interfaces, security groups, ...) before it prints the response.
+INSTANCE_FIELDS = [ "InstanceId", "Platform", "PublicIpAddress", "PublicDnsName", "PrivateIpAddress", "PrivateDnsName", "Tags" ]
+
+# Instances are requested in pages of this size (the maximum of DescribeInstances), so that
+# no more than one page is held in memory at a time
+PAGE_SIZE = 1000
+
+# Connections are handed from the region threads to the output through a bounded queue
+CONNECTION_QUEUE_SIZE = 1000
+
+# Size of the chunks in which the AWS CLI output is read
+READ_CHUNK_SIZE = 65536
+
+# At most this many accounts and regions are queried at the same time
+MAX_WORKERS = 32
+
+# Sharding splits the query of a region into disjoint filters that are paginated at the same time.
+# Sharding by state uses the states of the "instance-state-name" filter, or all of these.
+SHARD_STRATEGIES = [ "none", "zone", "state" ]
+INSTANCE_STATES = [ "pending", "running", "shutting-down", "terminated", "stopping", "stopped" ]
+DEFAULT_SHARD_PARALLELISM = 8
+
+# Assumed roles are given this session name, which shows up in CloudTrail. Their temporary
+# credentials are cached on disk and renewed once they expire within the refresh margin.
+ROLE_SESSION_NAME = "RoyalTS-DynamicFolder"
+CREDENTIALS_REFRESH_MARGIN = 300
+
+# Role ARNs in "Accounts" name a role in an account with a 12-digit ID, in any partition (aws, aws-cn, ...)
+ROLE_ARN_PATTERN = re.compile(r"^arn:aws[a-z-]*:iam::(\d{12}):role/\S+$")
+
+class AWSError(Exception):
+	# Raised for failed AWS CLI calls; the SDK raises its own exceptions
+	pass
+
+def print_error(message):
+	# Royal TS shows whatever the script writes to stderr
+	print(message, file=sys.stderr)
+
+def exit_with_error(message):
+	print_error(message)
+	sys.exit(1)
+
+class Account:
+	# An AWS account to grab instances from: the default credentials, a profile or a role to assume.
+	# The name is used for the account's folder.
+
+	def __init__(self, name, profile = "", role_arn = ""):
+		self.name = name
+		self.profile = profile
+		self.role_arn = role_arn
+		self.credentials = None
+		self.region = ""
+		self.regions = [ ]
+
+def get_accounts(accounts):
+	# A comma-separated list of profile names and role ARNs, or nothing for the default credentials.
+	# Malformed role ARNs are reported and skipped.
+	entries = accounts.replace(",", " ").split()
+	result = [ ]
+
+	for account in entries:
+		if account.startswith("arn:"):
+			# arn:aws:iam::123456789012:role/Name is named after the account ID
+			match = ROLE_ARN_PATTERN.match(account)
+
+			if not match:
+				print_error("Skipping the malformed role ARN \"" + account + "\", expected arn:aws:iam::<12-digit account ID>:role/<role name>")
+				continue
+
+			result.append(Account(match.group(1), role_arn=account))
+		else:
+			result.append(Account(account, profile=account))
+
+	if not entries:
+		return [ Account("") ]
+
+	return result
+
+class CredentialsCache:
+	# Temporary credentials of assumed roles by role ARN. The file contains secrets, so it is
+	# only readable by the current user.
+
+	def __init__(self, path):
+		self.path = path
+		self.entries = { }
+		self.changed = False
+		self.lock = threading.Lock()
+
+	def load(self):
+		try:
+			with open(self.path, "r") as cache_file:
+				self.entries = json.load(cache_file)
+		except (OSError, ValueError):
+			self.entries = { }
+
+	def save(self):
+		if not self.changed:
+			return
+
+		# Expired credentials are of no use anymore
+		entries = { role_arn: credentials for role_arn, credentials in self.entries.items() if credentials["Expiration"] > time.time() }
+
+		os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+		temp_path = self.path + ".tmp"
+
+		with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as cache_file:
+			json.dump(entries, cache_file)
+
+		os.replace(temp_path, self.path)
+
+	def get(self, role_arn):
+		with self.lock:
+			credentials = self.entries.get(role_arn)
+
+		if credentials is None or credentials["Expiration"] < time.time() + CREDENTIALS_REFRESH_MARGIN:
+			return None
+
+		return credentials
+
+	def set(self, role_arn, credentials):
+		with self.lock:
+			self.entries[role_arn] = credentials
+			self.changed = True
+
+def get_cache_dir():
+	if sys.platform == "win32":
+		base_dir = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+	elif sys.platform == "darwin":
+		base_dir = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+	else:
+		base_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+	return os.path.join(base_dir, "RoyalTS", "AWSEC2")
+
+def get_expiration(expiration):
+	# boto3 returns a datetime, the AWS CLI an ISO 8601 string
+	if isinstance(expiration, str):
+		expiration = datetime.datetime.fromisoformat(expiration.replace("Z", "+00:00"))
+
+	return expiration.timestamp()
+
+# Clients are thread-safe, but creating them from a shared session is not
+client_lock = threading.Lock()
+
+def get_client(session, account, service, region, endpoint_url):
+	# All clients share the session, which loads the API models only once. Accounts other than
+	# the default one pass their credentials to the client instead of having their own session.
+	with client_lock:
+		if account.credentials is None:
+			return session.client(service, region_name=region or None, endpoint_url=endpoint_url or None)
+
+		return session.client(service, region_name=region or account.region or None, endpoint_url=endpoint_url or None,
+			aws_access_key_id=account.credentials["AccessKeyId"],
+			aws_secret_access_key=account.credentials["SecretAccessKey"],
+			aws_session_token=account.credentials["SessionToken"])
+
+def get_ec2_client(session, account, region, endpoint_url):
+	return get_client(session, account, "ec2", region, endpoint_url)
+
+def get_aws_cli_command(args, region, endpoint_url, account):
+	aws_path = shutil.which("aws")
+
+	if aws_path is None:
+		raise AWSError("Neither the AWS SDK for Python (boto3) nor the AWS CLI is installed.")
+
+	cmd = [ aws_path ] + args + [ "--output", "json" ]
 
 	if region != "":
-		cmd += " --region " + region
+		cmd += [ "--region", region ]
+
+	if endpoint_url != "":
+		cmd += [ "--endpoint-url", endpoint_url ]
+
+	if account.profile != "":
+		cmd += [ "--profile", account.profile ]
+
+	return cmd
+
+def get_aws_cli_environment(account):
+	# Credentials of assumed roles are handed to the AWS CLI in its environment
+	if account.credentials is None:
+		return None
+
+	env = dict(os.environ)
+	env["AWS_ACCESS_KEY_ID"] = account.credentials["AccessKeyId"]
+	env["AWS_SECRET_ACCESS_KEY"] = account.credentials["SecretAccessKey"]
+	env["AWS_SESSION_TOKEN"] = account.credentials["SessionToken"]
+	env.pop("AWS_PROFILE", None)
+
+	return env
 
-	aws = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
+def get_aws_cli_error(args, exit_code, err):
+	return AWSError("aws " + " ".join(args[:2]) + " failed with exit code " + str(exit_code) + ": " + err.decode(errors="replace").strip())
+
+def run_aws_cli(args, region, endpoint_url, account):
+	aws = subprocess.Popen(get_aws_cli_command(args, region, endpoint_url, account), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=get_aws_cli_environment(account))
 	(response_json, err) = aws.communicate()
 	exit_code = aws.wait()
 
-	response = json.loads(response_json)
+	if exit_code != 0:
+		raise get_aws_cli_error(args, exit_code, err)
+
+	return json.loads(response_json)
+
+def iter_json_array(stream):
+	# Decodes a JSON array from a binary stream and yields its elements one by one, so that
+	# only the element being decoded and one chunk of input are held in memory
+	decoder = json.JSONDecoder()
+	text_decoder = codecs.getincrementaldecoder("utf-8")()
+	buffer = ""
+	position = 0
+	started = False
+
+	while True:
+		chunk = stream.read(READ_CHUNK_SIZE)
+		buffer = buffer[position:] + text_decoder.decode(chunk, final=not chunk)
+		position = 0
+
+		while True:
+			# Skip whitespace and the commas between elements
+			while position < len(buffer) and buffer[position] in " \t\r\n,":
+				position += 1
+
+			if position == len(buffer):
+				break
+
+			if not started:
+				# The CLI prints null instead of an empty array if there is nothing to query
+				if buffer.startswith("null", position):
+					return
+
+				if buffer[position] != "[":
+					raise ValueError("Expected a JSON array")
+
+				started = True
+				position += 1
+				continue
+
+			if buffer[position] == "]":
+				return
+
+			try:
+				element, position = decoder.raw_decode(buffer, position)
+			except ValueError:
+				if not chunk:
+					raise
+
+				# The element continues in the next chunk
+				break
+
+			yield element
+
+		if not chunk:
+			if started:
+				raise ValueError("Unexpected end of the JSON array")
+
+			return
+
+def run_aws_cli_array(args, region, endpoint_url, account):
+	# Like run_aws_cli(), but for commands that print a JSON array, which is parsed as it is read
+	with tempfile.TemporaryFile() as err_file:
+		# stderr goes to a file, so that the CLI can't block on a full pipe while stdout is read
+		aws = subprocess.Popen(get_aws_cli_command(args, region, endpoint_url, account), stdout=subprocess.PIPE, stderr=err_file, env=get_aws_cli_environment(account))
+
+		try:
+			for element in iter_json_array(aws.stdout):
+				yield element
+		except ValueError:
+			# Incomplete or no output at all, most likely because the command failed
+			if aws.wait() == 0:
+				raise
+		finally:
+			aws.stdout.close()
+			exit_code = aws.wait()
+
+		if exit_code != 0:
+			err_file.seek(0)
+			raise get_aws_cli_error(args, exit_code, err_file.read())
+
+def get_regions(regions, endpoint_url, session, account):
+	# A comma-separated list of regions, "all" for every region enabled for the account,
+	# or nothing for the default region
+	regions = regions.replace(",", " ").split()
+
+	if [ region.lower() for region in regions ] != [ "all" ]:
+		return regions or [ "" ]
+
+	if session is not None:
+		response = get_ec2_client(session, account, account.region or session.region_name or DEFAULT_REGION, endpoint_url).describe_regions()
+	else:
+		response = run_aws_cli([ "ec2", "describe-regions" ], DEFAULT_REGION, endpoint_url, account)
+
+	return sorted(region["RegionName"] for region in response.get("Regions", [ ]))
+
+def get_filters(states, tags, vpc_ids):
+	# Builds the server-side filters for DescribeInstances:
+	# - states: comma-separated instance states, e.g. "running, stopped"
+	# - tags: comma-separated "Key=Value" pairs, several values separated by "|" (e.g. "Environment=prod|staging"),
+	#   or just "Key" for instances that have the tag with any value
+	# - vpc_ids: comma-separated VPC IDs
+	filters = [ ]
+
+	states = [ state.strip().lower() for state in states.split(",") if state.strip() != "" ]
+
+	if states:
+		filters.append({ "Name": "instance-state-name", "Values": states })
+
+	for tag in tags.split(","):
+		key, separator, values = tag.partition("=")
+		key = key.strip()
+
+		if key == "":
+			continue
 
-	connections = [ ]
+		if separator:
+			filters.append({ "Name": "tag:" + key, "Values": [ value.strip() for value in values.split("|") ] })
+		else:
+			filters.append({ "Name": "tag-key", "Values": [ key ] })
 
-	for reservation in response.get("Reservations", None):
-		for instance in reservation.get("Instances", None):
-			instance_id = instance.get("InstanceId", "")
-			platform = instance.get("Platform", "")
+	vpc_ids = [ vpc_id.strip() for vpc_id in vpc_ids.split(",") if vpc_id.strip() != "" ]
 
-			is_windows = platform.lower() == "windows"
-			username = "Administrator" if is_windows else "ec2-user"
+	if vpc_ids:
+		filters.append({ "Name": "vpc-id", "Values": vpc_ids })
 
-			public_ip_address = instance.get("PublicIpAddress", "")
-			public_hostname = instance.get("PublicDnsName", "")
+	return filters
 
-			private_ip_address = instance.get("PrivateIpAddress", "")
-			private_hostname = instance.get("PrivateDnsName", "")
+def get_availability_zones(session, account, region, endpoint_url):
+	# Instances in Local Zones and Wavelength Zones need a shard as well, so the zones of zone
+	# groups the account hasn't opted in to are listed too; their shards are simply empty
+	if session is not None:
+		response = get_ec2_client(session, account, region, endpoint_url).describe_availability_zones(AllAvailabilityZones=True)
+	else:
+		response = run_aws_cli([ "ec2", "describe-availability-zones", "--all-availability-zones" ], region, endpoint_url, account)
 
-			tags = instance.get("Tags")
-			name = instance_id
+	return sorted(zone["ZoneName"] for zone in response.get("AvailabilityZones", [ ]))
 
-			if tags is not None:
-				for tag in tags:
-					if tag.get("Key", "").lower() == "name":
-						tagValue = tag.get("Value", "")
+def get_shards(session, account, region, endpoint_url, filters, shard_by):
+	# Returns the filters of every shard of a region. Each shard adds a filter with a single
+	# availability zone or instance state, so no instance matches more than one shard.
+	if shard_by == "zone":
+		zones = get_availability_zones(session, account, region, endpoint_url)
 
-						if tagValue.lower() != "":
-							name = tagValue
-						
-						break
+		return [ filters + [{ "Name": "availability-zone", "Values": [ zone ] }] for zone in zones ]
 
-			computer_name = public_hostname
+	if shard_by == "state":
+		states = INSTANCE_STATES
+		other_filters = [ ]
 
-			if computer_name == "":
-				computer_name = public_ip_address
+		for instance_filter in filters:
+			if instance_filter["Name"] == "instance-state-name":
+				states = instance_filter["Values"]
+			else:
+				other_filters.append(instance_filter)
+
+		return [ other_filters + [{ "Name": "instance-state-name", "Values": [ state ] }] for state in states ]
+
+	return [ filters ]
+
+def get_instances_boto3(session, account, region, endpoint_url, filters):
+	# The SDK pages through the results in-process, so every page is converted as it arrives
+	# and dropped right after. There is no server-side projection in the EC2 API.
+	ec2 = get_ec2_client(session, account, region, endpoint_url)
+
+	for page in ec2.get_paginator("describe_instances").paginate(Filters=filters, PaginationConfig={ "PageSize": PAGE_SIZE }):
+		for reservation in page.get("Reservations", [ ]):
+			for instance in reservation.get("Instances", [ ]):
+				yield instance
+
+def get_instances_cli(account, region, endpoint_url, filters):
+	# Only used if boto3 isn't installed. The query flattens the reservations and projects the
+	# instances to the used fields, which shrinks the output the script has to parse.
+	query = "Reservations[].Instances[].{" + ", ".join(field + ": " + field for field in INSTANCE_FIELDS) + "}"
+	args = [ "ec2", "describe-instances", "--page-size", str(PAGE_SIZE), "--query", query ]
+
+	if filters:
+		args += [ "--filters", json.dumps(filters) ]
+
+	return run_aws_cli_array(args, region, endpoint_url, account)
+
+def get_connection(instance):
+	# Fields that an instance doesn't have are null in the projected CLI output
+	instance_id = instance.get("InstanceId") or ""
+	platform = instance.get("Platform") or ""
+
+	is_windows = platform.lower() == "windows"
+	username = "Administrator" if is_windows else "ec2-user"
+
+	public_ip_address = instance.get("PublicIpAddress") or ""
+	public_hostname = instance.get("PublicDnsName") or ""
+
+	private_ip_address = instance.get("PrivateIpAddress") or ""
+	private_hostname = instance.get("PrivateDnsName") or ""
+
+	tags = instance.get("Tags")
+	name = instance_id
+
+	if tags is not None:
+		for tag in tags:
+			if tag.get("Key", "").lower() == "name":
+				tagValue = tag.get("Value", "")
+
+				if tagValue.lower() != "":
+					name = tagValue
+				
+				break
+
+	computer_name = public_hostname
+
+	if computer_name == "":
+		computer_name = public_ip_address
+
+	if computer_name == "":
+		computer_name = private_hostname
+
+	if computer_name == "":
+		computer_name = private_ip_address
+
+	connection = { }
+
+	if not is_windows:
+		connection["Type"] = "TerminalConnection"
+		connection["TerminalConnectionType"] = "SSH"
+	else:
+		connection["Type"] = "RemoteDesktopConnection"
+
+	connection["ID"] = instance_id
+	connection["Name"] = name
+	connection["ComputerName"] = computer_name
+	connection["Username"] = username
+
+	return connection
+
+def assume_role(session, account, endpoint_url, credentials_cache):
+	credentials = credentials_cache.get(account.role_arn) if credentials_cache else None
+
+	if credentials is None:
+		# The role is assumed with the default credentials
+		default_account = Account("")
+
+		if session is not None:
+			sts = get_client(session, default_account, "sts", session.region_name or DEFAULT_REGION, endpoint_url)
+			response = sts.assume_role(RoleArn=account.role_arn, RoleSessionName=ROLE_SESSION_NAME)
+		else:
+			response = run_aws_cli([ "sts", "assume-role", "--role-arn", account.role_arn, "--role-session-name", ROLE_SESSION_NAME ], DEFAULT_REGION, endpoint_url, default_account)
+
+		credentials = {
+			"AccessKeyId": response["Credentials"]["AccessKeyId"],
+			"SecretAccessKey": response["Credentials"]["SecretAccessKey"],
+			"SessionToken": response["Credentials"]["SessionToken"],
+			"Expiration": get_expiration(response["Credentials"]["Expiration"])
+		}
+
+		if credentials_cache:
+			credentials_cache.set(account.role_arn, credentials)
+
+	account.credentials = credentials
+
+def prepare_account(session, account, regions, endpoint_url, credentials_cache):
+	# Gets the credentials of the account and the regions to query in it
+	if account.role_arn != "":
+		assume_role(session, account, endpoint_url, credentials_cache)
+	elif account.profile != "" and session is not None:
+		# The profile is only used to resolve its credentials and region (the AWS CLI is given the profile instead)
+		import boto3
+
+		with client_lock:
+			profile_session = boto3.session.Session(profile_name=account.profile)
+
+		profile_credentials = profile_session.get_credentials()
+
+		if profile_credentials is None:
+			raise AWSError("The profile has no credentials.")
+
+		frozen_credentials = profile_credentials.get_frozen_credentials()
+
+		account.credentials = {
+			"AccessKeyId": frozen_credentials.access_key,
+			"SecretAccessKey": frozen_credentials.secret_key,
+			"SessionToken": frozen_credentials.token
+		}
+		account.region = profile_session.region_name or ""
+
+	account.regions = get_regions(regions, endpoint_url, session, account)
+
+def get_region_connections(session, account, region, endpoint_url, filters):
+	if session is not None:
+		instances = get_instances_boto3(session, account, region, endpoint_url, filters)
+	else:
+		instances = get_instances_cli(account, region, endpoint_url, filters)
+
+	for instance in instances:
+		yield get_connection(instance)
 
-			if computer_name == "":
-				computer_name = private_hostname
+def get_folder_path(account, region, accounts, max_regions):
+	# Every account and every region gets its own folder if there is more than one of them
+	path = [ ]
 
-			if computer_name == "":
-				computer_name = private_ip_address
+	if len(accounts) > 1:
+		path.append(account.name)
 
-			connection = { }
+	if max_regions > 1:
+		path.append(region)
 
-			if not is_windows:
-				connection["Type"] = "TerminalConnection"
-				connection["TerminalConnectionType"] = "SSH"
+	return "/".join(path)
+
+def get_connections(session, accounts, endpoint_url, filters, failures, shard_by = "none", shard_parallelism = DEFAULT_SHARD_PARALLELISM):
+	# All regions of all accounts are queried at the same time and their connections are yielded
+	# as they arrive. A region that fails is reported, added to failures and skipped.
+	results = queue.Queue(maxsize=CONNECTION_QUEUE_SIZE)
+	tasks = [ (account, region) for account in accounts for region in account.regions ]
+	max_regions = max(len(account.regions) for account in accounts)
+
+	# An instance can change its state while the shards are paginated and then show up in two of
+	# them, so the IDs of the yielded instances are remembered per account and region
+	seen_instance_ids = { }
+
+	def fetch_shard(account, region, shard_filters):
+		for connection in get_region_connections(session, account, region, endpoint_url, shard_filters):
+			results.put((account, region, connection, None))
+
+	def fetch_region(account, region):
+		try:
+			shards = get_shards(session, account, region, endpoint_url, filters, shard_by)
+
+			if len(shards) <= 1 or shard_parallelism <= 1:
+				for shard_filters in shards:
+					fetch_shard(account, region, shard_filters)
 			else:
-				connection["Type"] = "RemoteDesktopConnection"
+				with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(shards), shard_parallelism)) as shard_executor:
+					shard_futures = [ shard_executor.submit(fetch_shard, account, region, shard_filters) for shard_filters in shards ]
+
+				for shard_future in shard_futures:
+					shard_future.result()
+		except Exception as e:
+			# Missing credentials, unknown regions, denied API calls etc.
+			results.put((account, region, None, e))
+			return
+
+		results.put((account, region, None, None))
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(tasks), MAX_WORKERS)) as executor:
+		for account, region in tasks:
+			executor.submit(fetch_region, account, region)
+
+		remaining_tasks = len(tasks)
+
+		while remaining_tasks > 0:
+			account, region, connection, error = results.get()
+
+			if connection is None:
+				remaining_tasks -= 1
+
+				if error is not None:
+					location = region or "the default region"
+
+					if account.name != "":
+						location += " of " + account.name
+
+					print_error("Could not describe the EC2 instances in " + location + ": " + str(error))
+					failures.append((account, region))
+
+				continue
+
+			if shard_by != "none":
+				instance_ids = seen_instance_ids.setdefault((account.name, region), set())
+
+				if connection["ID"] in instance_ids:
+					continue
+
+				instance_ids.add(connection["ID"])
+
+			path = get_folder_path(account, region, accounts, max_regions)
+
+			if path != "":
+				connection["Path"] = path
+
+			yield connection
+
+def write_store(connections, output):
+	# Writes the RoyalJSON document one connection at a time instead of building it in memory
+	output.write("{\"Objects\": [")
+
+	for index, connection in enumerate(connections):
+		if index > 0:
+			output.write(", ")
+
+		output.write(json.dumps(connection))
+
+	output.write("]}\n")
+
+def get_instances(regions = "", endpoint_url = "", filters = [ ], accounts = "", cache_credentials = True, shard_by = "", shard_parallelism = "", output = sys.stdout):
+	endpoint_url = endpoint_url.strip()
+	shard_by = shard_by.strip().lower() or "none"
+
+	if shard_by not in SHARD_STRATEGIES:
+		exit_with_error("Unknown shard strategy \"" + shard_by + "\", expected one of: " + ", ".join(SHARD_STRATEGIES))
+
+	try:
+		shard_parallelism = int(shard_parallelism.strip() or DEFAULT_SHARD_PARALLELISM)
+	except ValueError:
+		exit_with_error("The shard parallelism must be a number.")
+
+	try:
+		import boto3
+		session = boto3.session.Session()
+	except ImportError:
+		session = None
+
+	accounts = get_accounts(accounts)
+	credentials_cache = None
+
+	if not accounts:
+		sys.exit(1)
+
+	if cache_credentials and any(account.role_arn != "" for account in accounts):
+		credentials_cache = CredentialsCache(os.path.join(get_cache_dir(), "sts-credentials.json"))
+		credentials_cache.load()
+
+	# Roles are assumed and regions are listed for all accounts at the same time.
+	# An account that can't be accessed is reported and skipped.
+	with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(accounts), MAX_WORKERS)) as executor:
+		futures = [ executor.submit(prepare_account, session, account, regions, endpoint_url, credentials_cache) for account in accounts ]
+
+	available_accounts = [ ]
+
+	for account, future in zip(accounts, futures):
+		try:
+			future.result()
+			available_accounts.append(account)
+		except Exception as e:
+			if account.name != "":
+				print_error("Could not access " + account.name + ": " + str(e))
+			else:
+				print_error("Could not list the regions: " + str(e))
+
+	if credentials_cache:
+		try:
+			credentials_cache.save()
+		except OSError as e:
+			print_error("Could not cache the credentials: " + str(e))
 
-			connection["ID"] = instance_id
-			connection["Name"] = name
-			connection["ComputerName"] = computer_name
-			connection["Username"] = username
+	if not available_accounts:
+		sys.exit(1)
 
-			connections.append(connection)
+	failures = [ ]
 
-	store = {
-		"Objects": connections
-	}
+	write_store(get_connections(session, available_accounts, endpoint_url, filters, failures, shard_by, shard_parallelism), output)
 
-	store_json = json.dumps(store)
+	if len(failures) == sum(len(account.regions) for account in available_accounts):
+		sys.exit(1)
 
-	return store_json
+filters = get_filters("$CustomProperty.InstanceStates$", "$CustomProperty.TagFilters$", "$CustomProperty.VPCIDs$")
 
-print(get_instances("$CustomProperty.Region$"))
\ No newline at end of file
+get_instances("$CustomProperty.Region$", "$CustomProperty.EndpointURL$", filters, "$CustomProperty.Accounts$", "$CustomProperty.CacheCredentials$".strip().lower() != "false", "$CustomProperty.ShardBy$", "$CustomProperty.ShardParallelism$")
\ No newline at end of file
@@ -9,52 +9,175 @@
 # ----------------------
 
 import subprocess
+import shutil
 import json
+import sys
+import concurrent.futures
+import threading
 
-def get_instances(region = ""):
-	cmd = "aws ssm describe-instance-information --output json"
+# Managed instances are requested in pages of this size (the maximum of DescribeInstanceInformation)
+SSM_PAGE_SIZE = 50
+
+# The EC2 instances of the managed instances are looked up in batches of this many instance IDs
+EC2_BATCH_SIZE = 200
+
+# At most this many batches are looked up at the same time
+MAX_WORKERS = 8
+
+class AWSError(Exception):
+	# Raised for failed AWS CLI calls; the SDK raises its own exceptions
+	pass
+
+def print_error(message):
+	# Royal TS shows whatever the script writes to stderr
+	print(message, file=sys.stderr)
+
+def exit_with_error(message):
+	print_error(message)
+	sys.exit(1)
+
+# Clients are thread-safe, but creating them from a shared session is not. Creating one takes
+# long enough to dominate a lookup batch, so every batch shares the client of its service.
+client_lock = threading.Lock()
+clients = { }
+
+def get_client(session, service, region):
+	with client_lock:
+		if service not in clients:
+			clients[service] = session.client(service, region_name=region or None)
+
+		return clients[service]
+
+def run_aws_cli(args, region):
+	aws_path = shutil.which("aws")
+
+	if aws_path is None:
+		raise AWSError("Neither the AWS SDK for Python (boto3) nor the AWS CLI is installed.")
+
+	cmd = [ aws_path ] + args + [ "--output", "json" ]
 
 	if region != "":
-		cmd += " --region " + region
+		cmd += [ "--region", region ]
 
-	aws = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
+	aws = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 	(response_json, err) = aws.communicate()
 	exit_code = aws.wait()
 
-	response = json.loads(response_json)
+	if exit_code != 0:
+		raise AWSError("aws " + " ".join(args[:2]) + " failed with exit code " + str(exit_code) + ": " + err.decode(errors="replace").strip())
+
+	return json.loads(response_json)
+
+def get_managed_instance_pages(session, region):
+	# Yields the managed instances page by page, so that their EC2 instances can be looked up
+	# while the next page is requested. The AWS CLI pages through all of them in one call.
+	if session is not None:
+		ssm = get_client(session, "ssm", region)
 
-	connections = [ ]
+		for page in ssm.get_paginator("describe_instance_information").paginate(PaginationConfig={ "PageSize": SSM_PAGE_SIZE }):
+			yield page.get("InstanceInformationList", [ ])
+	else:
+		response = run_aws_cli([ "ssm", "describe-instance-information" ], region)
 
-	for instance in response.get("InstanceInformationList", None):
-		instance_id = instance.get("InstanceId", "")
-		platform = instance.get("PlatformType", "")
+		yield response.get("InstanceInformationList", [ ])
 
-		is_windows = platform.lower() == "windows"
+def get_ec2_instances(session, region, instance_ids):
+	# Returns the EC2 instances with the given IDs by ID. They are filtered instead of passed as
+	# InstanceIds, which would fail the whole batch if a single instance doesn't exist anymore.
+	filters = [{ "Name": "instance-id", "Values": instance_ids }]
+	instances = { }
 
-		computer_name = instance.get("ComputerName", "")
-		private_ip_address = instance.get("IPAddress", "")
+	if session is not None:
+		ec2 = get_client(session, "ec2", region)
 
-		name = instance_id
+		for page in ec2.get_paginator("describe_instances").paginate(Filters=filters):
+			for reservation in page.get("Reservations", [ ]):
+				for instance in reservation.get("Instances", [ ]):
+					instances[instance["InstanceId"]] = instance
+	else:
+		query = "Reservations[].Instances[].{InstanceId: InstanceId, Platform: Platform, Tags: Tags}"
 
-		connection = { }
-		if not is_windows:
-			connection["Type"] = "TerminalConnection"
-			connection["TerminalConnectionType"] = "CustomTerminal"
-		else:
-			connection["Type"] = "RemoteDesktopConnection"
+		for instance in run_aws_cli([ "ec2", "describe-instances", "--filters", json.dumps(filters), "--query", query ], region) or [ ]:
+			instances[instance["InstanceId"]] = instance
 
-		connection["ID"] = instance_id
-		connection["Name"] = computer_name
-		connection["ComputerName"] = computer_name
+	return instances
 
-		connection["CustomCommand"] = f"aws ssm start-session --target {instance_id}"		
-		
-		
-		connection["Properties"] = {}
-		connection["Properties"]["RunInsideLoginShell"] = True
-		
-		
-		connections.append(connection)
+def get_name_tag(instance):
+	for tag in instance.get("Tags") or [ ]:
+		if tag.get("Key", "").lower() == "name":
+			return tag.get("Value", "")
+
+	return ""
+
+def get_connection(instance, ec2_instance):
+	instance_id = instance.get("InstanceId", "")
+	platform = instance.get("PlatformType", "")
+
+	# The EC2 platform is only set for Windows instances
+	is_windows = platform.lower() == "windows" or (ec2_instance.get("Platform") or "").lower() == "windows"
+
+	computer_name = instance.get("ComputerName", "")
+
+	name = get_name_tag(ec2_instance) or computer_name
+
+	connection = { }
+	if not is_windows:
+		connection["Type"] = "TerminalConnection"
+		connection["TerminalConnectionType"] = "CustomTerminal"
+	else:
+		connection["Type"] = "RemoteDesktopConnection"
+
+	connection["ID"] = instance_id
+	connection["Name"] = name
+	connection["ComputerName"] = computer_name
+
+	connection["CustomCommand"] = f"aws ssm start-session --target {instance_id}"
+
+	connection["Properties"] = {}
+	connection["Properties"]["RunInsideLoginShell"] = True
+
+	return connection
+
+def get_instances(region = ""):
+	try:
+		import boto3
+		session = boto3.session.Session()
+	except ImportError:
+		session = None
+
+	managed_instances = [ ]
+	futures = [ ]
+
+	# Every page of managed instances is joined with its EC2 instances by instance ID. The EC2
+	# instances are looked up in batches, while the managed instances are still being paged through.
+	with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+		try:
+			for page in get_managed_instance_pages(session, region):
+				managed_instances += page
+
+				# Hybrid managed nodes (mi-...) aren't EC2 instances
+				instance_ids = [ instance["InstanceId"] for instance in page if instance.get("InstanceId", "").startswith("i-") ]
+
+				for start in range(0, len(instance_ids), EC2_BATCH_SIZE):
+					futures.append(executor.submit(get_ec2_instances, session, region, instance_ids[start:start + EC2_BATCH_SIZE]))
+		except Exception as e:
+			exit_with_error("Could not describe the managed instances: " + str(e))
+
+	ec2_instances = { }
+	errors = [ ]
+
+	# Instances of failed batches are named after their computer names. A missing permission
+	# fails every batch, so only the first error is reported, together with the number of failures.
+	for future in futures:
+		try:
+			ec2_instances.update(future.result())
+		except Exception as e:
+			errors.append(e)
+
+	if errors:
+		print_error("Could not describe the EC2 instances" + (" (" + str(len(errors)) + " of " + str(len(futures)) + " batches)" if len(futures) > 1 else "") + ": " + str(errors[0]))
+
+	connections = [ get_connection(instance, ec2_instances.get(instance.get("InstanceId", ""), { })) for instance in managed_instances ]
 
 	store = {
 		"Objects": connections
@@ -63,5 +186,5 @@ def get_instances(region = ""):
 	store_json = json.dumps(store)
 
 	return store_json
-	
+
 print(get_instances("$CustomProperty.Region$"))
@@ -0,0 +1,774 @@
+#!/usr/bin/env python3
+
+# Synthetic fleet benchmark for the AWS EC2 and AWS EC2 SSM Dynamic Folder scripts.
+#
+# Generates DescribeInstances and DescribeInstanceInformation responses for fleets of
+# random instances, serves them through a stub "aws" executable on PATH (AWS CLI code path)
+# and a stub EC2 and SSM endpoint on localhost (boto3 code path), and reports the wall time,
+# memory usage and data size of every phase of the scripts. Runs offline.
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import http.server
+import urllib.parse
+import importlib.util
+import concurrent.futures
+from xml.sax.saxutils import escape
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPTS = {
+	"ec2": os.path.join(SCRIPT_DIR, "..", "AWS EC2 (Python).rdfe"),
+	"ssm": os.path.join(SCRIPT_DIR, "..", "AWS EC2 SSM (Python).rdfe")
+}
+
+# The statements that run the scripts, which are cut off to load their functions
+ENTRY_POINTS = {
+	"ec2": "\nfilters = get_filters(",
+	"ssm": "\nprint(get_instances("
+}
+
+REGION = "us-east-1"
+
+# "cli" runs the scripts without boto3 against the stub "aws" executable, "sdk" runs them
+# with boto3 against the stub endpoint
+BACKENDS = ["cli", "sdk"]
+
+# The stub endpoint pages through DescribeInstances like EC2 if the request sets no page size
+DEFAULT_PAGE_SIZE = 1000
+
+# The DescribeInstances fields of the instances by their element names in the EC2 query API
+EC2_XML_FIELDS = [("instanceId", "InstanceId"), ("platform", "Platform"), ("privateIpAddress", "PrivateIpAddress"), ("privateDnsName", "PrivateDnsName"), ("ipAddress", "PublicIpAddress"), ("dnsName", "PublicDnsName")]
+
+# Instance IDs are made from the index of the instance, so that the stub can recreate any
+# instance from its ID alone
+INSTANCE_ID_OFFSET = 0x1000000
+
+# One in this many managed instances is a hybrid node (mi-...) without an EC2 instance
+HYBRID_RATIO = 100
+
+TAG_KEYS = ["Environment", "Team", "Owner", "CostCenter", "Application", "Backup", "Patch Group", "aws:autoscaling:groupName"]
+TAG_VALUES = ["prod", "staging", "dev", "web", "ops", "data", "true", "false", "weekly", "eu-central", "team-a", "team-b"]
+
+
+def get_instance_id(index):
+	return "i-%017x" % (INSTANCE_ID_OFFSET + index)
+
+
+def get_instance_index(instance_id):
+	return int(instance_id[2:], 16) - INSTANCE_ID_OFFSET
+
+
+def make_instance(seed, index):
+	# Returns the DescribeInstances fields of an instance that the scripts use, with random
+	# tags and platform
+	rng = random.Random(seed * 1000003 + index)
+	private_ip_address = "10.%d.%d.%d" % (rng.randrange(256), rng.randrange(256), rng.randrange(1, 255))
+
+	instance = {
+		"InstanceId": get_instance_id(index),
+		"PrivateIpAddress": private_ip_address,
+		"PrivateDnsName": "ip-" + private_ip_address.replace(".", "-") + ".ec2.internal"
+	}
+
+	if rng.random() < 0.2:
+		instance["Platform"] = "windows"
+
+	if rng.random() < 0.5:
+		public_ip_address = "%d.%d.%d.%d" % (rng.randrange(1, 224), rng.randrange(256), rng.randrange(256), rng.randrange(1, 255))
+		instance["PublicIpAddress"] = public_ip_address
+		instance["PublicDnsName"] = "ec2-" + public_ip_address.replace(".", "-") + ".compute-1.amazonaws.com"
+
+	tags = [ ]
+
+	if rng.random() < 0.9:
+		tags.append({ "Key": "Name", "Value": "%s-%s-%05d" % (rng.choice(TAG_VALUES), rng.choice(["web", "db", "app", "cache"]), index) })
+
+	for key in rng.sample(TAG_KEYS, rng.randrange(len(TAG_KEYS))):
+		tags.append({ "Key": key, "Value": rng.choice(TAG_VALUES) })
+
+	if tags:
+		instance["Tags"] = tags
+
+	return instance
+
+
+def make_instance_information(seed, index):
+	# Returns the DescribeInstanceInformation entry of a managed instance
+	if index % HYBRID_RATIO == HYBRID_RATIO - 1:
+		return {
+			"InstanceId": "mi-%017x" % (INSTANCE_ID_OFFSET + index),
+			"PingStatus": "Online",
+			"PlatformType": "Linux",
+			"PlatformName": "Ubuntu",
+			"PlatformVersion": "22.04",
+			"ResourceType": "ManagedInstance",
+			"IPAddress": "192.168.%d.%d" % (index // 256 % 256, index % 256),
+			"ComputerName": "onprem-%05d" % index
+		}
+
+	instance = make_instance(seed, index)
+	is_windows = instance.get("Platform") == "windows"
+
+	return {
+		"InstanceId": instance["InstanceId"],
+		"PingStatus": "Online",
+		"LastPingDateTime": "2024-05-01T12:00:00.000000+00:00",
+		"AgentVersion": "3.3.380.0",
+		"IsLatestVersion": False,
+		"PlatformType": "Windows" if is_windows else "Linux",
+		"PlatformName": "Microsoft Windows Server 2022 Datacenter" if is_windows else "Amazon Linux",
+		"PlatformVersion": "10.0.20348" if is_windows else "2023",
+		"ResourceType": "EC2Instance",
+		"IPAddress": instance["PrivateIpAddress"],
+		"ComputerName": instance["PrivateDnsName"],
+		"AssociationStatus": "Success",
+		"SourceId": instance["InstanceId"],
+		"SourceType": "AWS::EC2::Instance"
+	}
+
+
+def get_query_fields(args):
+	# The scripts project the instances with queries like "...{InstanceId: InstanceId, Tags: Tags}"
+	if "--query" not in args:
+		return None
+
+	return re.findall(r"(\w+): \1\b", args[args.index("--query") + 1])
+
+
+def project(instance, fields):
+	if fields is None:
+		return instance
+
+	return { field: instance.get(field) for field in fields }
+
+
+def write_payloads(directory, seed, count):
+	# The listings of the whole fleet are written once and streamed by the stub
+	with open(os.path.join(directory, "describe-instances.json"), "w") as payload_file:
+		write_array(payload_file, (make_instance(seed, index) for index in range(count)))
+
+	with open(os.path.join(directory, "describe-instance-information.json"), "w") as payload_file:
+		payload_file.write("{\"InstanceInformationList\": ")
+		write_array(payload_file, (make_instance_information(seed, index) for index in range(count)))
+		payload_file.write("}")
+
+
+def write_array(output, elements):
+	output.write("[")
+
+	for index, element in enumerate(elements):
+		if index > 0:
+			output.write(", ")
+
+		output.write(json.dumps(element))
+
+	output.write("]")
+
+
+def stub_aws(args):
+	# Entry point of the stub "aws" executable. It prints the pregenerated listings, or the
+	# instances selected by an "instance-id" filter, like the AWS CLI with --output json.
+	directory = os.environ["BENCHMARK_PAYLOAD_DIR"]
+	seed = int(os.environ["BENCHMARK_SEED"])
+	command = args[:2]
+
+	filters = json.loads(args[args.index("--filters") + 1]) if "--filters" in args else [ ]
+	instance_ids = [ value for instance_filter in filters if instance_filter["Name"] == "instance-id" for value in instance_filter["Values"] ]
+
+	if command == ["ssm", "describe-instance-information"]:
+		payload_path = os.path.join(directory, "describe-instance-information.json")
+	elif command == ["ec2", "describe-instances"] and instance_ids:
+		fields = get_query_fields(args)
+		json.dump([ project(make_instance(seed, get_instance_index(instance_id)), fields) for instance_id in instance_ids ], sys.stdout)
+		return
+	elif command == ["ec2", "describe-instances"]:
+		# Every instance is running and matches the other filters. The listing only has the
+		# fields of the EC2 script's query.
+		payload_path = os.path.join(directory, "describe-instances.json")
+	else:
+		sys.exit("The stub doesn't implement aws " + " ".join(command))
+
+	with open(payload_path, "rb") as payload_file:
+		while True:
+			chunk = payload_file.read(65536)
+
+			if not chunk:
+				break
+
+			sys.stdout.buffer.write(chunk)
+
+
+def get_instance_xml(instance):
+	# Returns an item of the instancesSet of a DescribeInstances response
+	xml = [ "<item>" ]
+
+	for element, field in EC2_XML_FIELDS:
+		if field in instance:
+			xml.append("<" + element + ">" + escape(instance[field]) + "</" + element + ">")
+
+	xml.append("<instanceState><code>16</code><name>running</name></instanceState>")
+
+	if "Tags" in instance:
+		xml.append("<tagSet>" + "".join("<item><key>" + escape(tag["Key"]) + "</key><value>" + escape(tag["Value"]) + "</value></item>" for tag in instance["Tags"]) + "</tagSet>")
+
+	xml.append("</item>")
+
+	return "".join(xml)
+
+
+def describe_instances(seed, count, params):
+	# Answers DescribeInstances (EC2 query API, form-encoded parameters) with a page of the fleet,
+	# or with the instances selected by an "instance-id" filter
+	filter_prefixes = [ key[:-len("Name")] for key, values in params.items() if re.fullmatch(r"Filter\.\d+\.Name", key) and values == [ "instance-id" ] ]
+	instance_ids = [ values[0] for key, values in params.items() if any(key.startswith(prefix + "Value.") for prefix in filter_prefixes) ]
+	next_token = None
+
+	if filter_prefixes:
+		indexes = [ get_instance_index(instance_id) for instance_id in instance_ids ]
+	else:
+		start = int(params.get("NextToken", [ "0" ])[0])
+		stop = min(count, start + int(params.get("MaxResults", [ str(DEFAULT_PAGE_SIZE) ])[0]))
+		indexes = range(start, stop)
+
+		if stop < count:
+			next_token = str(stop)
+
+	instances = "".join(get_instance_xml(make_instance(seed, index)) for index in indexes)
+	reservations = "<item><reservationId>r-benchmark</reservationId><ownerId>123456789012</ownerId><groupSet/><instancesSet>" + instances + "</instancesSet></item>" if instances else ""
+
+	return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<DescribeInstancesResponse xmlns=\"http://ec2.amazonaws.com/doc/2016-11-15/\">"
+		+ "<requestId>benchmark</requestId><reservationSet>" + reservations + "</reservationSet>"
+		+ ("<nextToken>" + next_token + "</nextToken>" if next_token else "") + "</DescribeInstancesResponse>")
+
+
+def describe_instance_information(seed, count, request):
+	# Answers DescribeInstanceInformation (SSM JSON API) with a page of the fleet
+	start = int(request.get("NextToken") or 0)
+	stop = min(count, start + request.get("MaxResults", 50))
+	response = { "InstanceInformationList": [ make_instance_information(seed, index) for index in range(start, stop) ] }
+
+	if stop < count:
+		response["NextToken"] = str(stop)
+
+	return json.dumps(response)
+
+
+class StubEndpointHandler(http.server.BaseHTTPRequestHandler):
+	# Like the "aws" stub, every instance is running and matches all filters but "instance-id".
+	# The connections are kept alive like AWS does, without delaying the bodies of the responses.
+	protocol_version = "HTTP/1.1"
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		target = self.headers.get("X-Amz-Target", "")
+
+		if target == "AmazonSSM.DescribeInstanceInformation":
+			content_type = "application/x-amz-json-1.1"
+			payload = describe_instance_information(self.server.seed, self.server.count, json.loads(body or b"{}"))
+		else:
+			params = urllib.parse.parse_qs(body.decode())
+
+			if params.get("Action") != [ "DescribeInstances" ]:
+				self.send_error(400, "The stub doesn't implement " + (target or " ".join(params.get("Action", [ ]))))
+				return
+
+			content_type = "text/xml"
+			payload = describe_instances(self.server.seed, self.server.count, params)
+
+		data = payload.encode()
+
+		self.send_response(200)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+class StubEndpoint(http.server.ThreadingHTTPServer):
+	# Serves the EC2 and SSM API calls of the scripts' boto3 code path on localhost, for the
+	# fleet of the current seed and size. The scripts find it through AWS_ENDPOINT_URL.
+	daemon_threads = True
+
+	def __init__(self, seed):
+		super().__init__(("127.0.0.1", 0), StubEndpointHandler)
+		self.seed = seed
+		self.count = 0
+
+	@property
+	def url(self):
+		return "http://127.0.0.1:" + str(self.server_address[1])
+
+
+def install_stub(directory):
+	# Puts an "aws" executable that calls stub_aws() and a boto3 module that fails to import
+	# into the directory, which get_environment() puts on the search paths of the CLI backend
+	stub_path = os.path.join(directory, "aws")
+
+	with open(stub_path, "w") as stub_file:
+		stub_file.write("#!" + sys.executable + "\n")
+		stub_file.write("import sys\nsys.path.insert(0, " + repr(SCRIPT_DIR) + ")\n")
+		stub_file.write("import benchmark\nbenchmark.stub_aws(sys.argv[1:])\n")
+
+	os.chmod(stub_path, 0o755)
+
+	with open(os.path.join(directory, "boto3.py"), "w") as boto3_file:
+		boto3_file.write("raise ImportError(\"boto3 is disabled by the benchmark\")\n")
+
+
+def get_environment(backend, directory, endpoint):
+	# The environment of the scripts and the phases process of a backend
+	environment = dict(os.environ)
+
+	if backend == "cli":
+		environment["PATH"] = directory + os.pathsep + environment.get("PATH", "")
+		environment["PYTHONPATH"] = directory + os.pathsep + environment.get("PYTHONPATH", "")
+	else:
+		environment["AWS_ENDPOINT_URL"] = endpoint.url
+		environment["AWS_EC2_METADATA_DISABLED"] = "true"
+
+	# The stubs don't need credentials, but keep them from being looked up
+	environment["AWS_ACCESS_KEY_ID"] = "benchmark"
+	environment["AWS_SECRET_ACCESS_KEY"] = "benchmark"
+
+	return environment
+
+
+def load_script(name):
+	# The .rdfe file is the source of truth for the script and the default custom property values
+	with open(SCRIPTS[name], "r", encoding="utf-8") as rdfe_file:
+		folder = json.load(rdfe_file)["Objects"][0]
+
+	properties = { }
+
+	for prop in folder["CustomProperties"]:
+		if prop["Type"] != "Header":
+			properties[prop["Name"].replace(" ", "")] = prop["Value"]
+
+	properties["Region"] = REGION
+
+	return re.sub(r"\$CustomProperty\.(\w+)\$", lambda match: str(properties.get(match.group(1), "")), folder["Script"])
+
+
+def load_module(name, script):
+	definitions, separator, _ = script.rpartition(ENTRY_POINTS[name])
+
+	if not separator:
+		raise ValueError("Unexpected structure of the " + name + " script")
+
+	module = { "__name__": "benchmark_" + name }
+	exec(compile(definitions, SCRIPTS[name], "exec"), module)
+
+	return module
+
+
+class CapturedArguments(Exception):
+	pass
+
+
+def capture_aws_cli_args(module, function_name, call):
+	# Calls a function of the script with its AWS CLI helper replaced, and returns the
+	# arguments that the function passed to the AWS CLI
+	original = module[function_name]
+
+	def capture(args, *rest):
+		raise CapturedArguments(args)
+
+	module[function_name] = capture
+
+	try:
+		result = call()
+
+		# Generators only call the helper once they are iterated
+		if hasattr(result, "__next__"):
+			next(result)
+	except CapturedArguments as captured:
+		return captured.args[0]
+	finally:
+		module[function_name] = original
+
+	raise ValueError(function_name + " wasn't called")
+
+
+def fetch(args):
+	# Runs the stub the way the scripts run the AWS CLI and returns its raw output
+	cmd = [ "aws" ] + args + [ "--output", "json", "--region", REGION ]
+
+	return subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+
+
+class CountingWriter:
+	# Stands in for stdout and only counts the written characters
+
+	def __init__(self):
+		self.size = 0
+
+	def write(self, text):
+		self.size += len(text)
+
+
+def get_session():
+	import boto3
+
+	return boto3.session.Session()
+
+
+def get_ec2_phases(module, backend):
+	account = module["Account"]("")
+
+	if backend == "sdk":
+		session = get_session()
+
+		def fetch_phase(state):
+			# The SDK parses every page as it arrives, so there is no separate parse phase
+			state["instances"] = list(module["get_instances_boto3"](session, account, REGION, "", [ ]))
+			return len(state["instances"])
+
+		fetch_phases = [ ("fetch", "instances", fetch_phase) ]
+	else:
+		args = capture_aws_cli_args(module, "run_aws_cli_array", lambda: module["get_instances_cli"](account, REGION, "", [ ]))
+
+		def fetch_phase(state):
+			state["payload"] = fetch(args)
+			return len(state["payload"])
+
+		def parse_phase(state):
+			state["instances"] = list(module["iter_json_array"](io.BytesIO(state["payload"])))
+			return len(state["instances"])
+
+		fetch_phases = [ ("fetch", "bytes", fetch_phase), ("parse", "instances", parse_phase) ]
+
+	def convert_phase(state):
+		state["connections"] = [ module["get_connection"](instance) for instance in state["instances"] ]
+		return len(state["connections"])
+
+	def serialize_phase(state):
+		output = CountingWriter()
+		module["write_store"](iter(state["connections"]), output)
+		return output.size
+
+	return fetch_phases + [ ("convert", "connections", convert_phase), ("serialize", "bytes", serialize_phase) ]
+
+
+def get_lookup_batches(module, pages):
+	# The EC2 instances of every page of managed instances are looked up in batches, like the script does
+	batches = [ ]
+	batch_size = module["EC2_BATCH_SIZE"]
+
+	for page in pages:
+		instance_ids = [ instance["InstanceId"] for instance in page if instance["InstanceId"].startswith("i-") ]
+		batches += [ instance_ids[start:start + batch_size] for start in range(0, len(instance_ids), batch_size) ]
+
+	return batches
+
+
+def get_ssm_phases(module, backend):
+	if backend == "sdk":
+		session = get_session()
+
+		def fetch_phase(state):
+			state["pages"] = list(module["get_managed_instance_pages"](session, REGION))
+			state["managed_instances"] = [ instance for page in state["pages"] for instance in page ]
+			return len(state["managed_instances"])
+
+		def fetch_lookups_phase(state):
+			# The batches are fetched at the same time, like the script does
+			state["ec2_instances"] = { }
+
+			with concurrent.futures.ThreadPoolExecutor(max_workers=module["MAX_WORKERS"]) as executor:
+				for instances in executor.map(lambda batch: module["get_ec2_instances"](session, REGION, batch), get_lookup_batches(module, state["pages"])):
+					state["ec2_instances"].update(instances)
+
+			return len(state["ec2_instances"])
+
+		fetch_phases = [ ("fetch", "instances", fetch_phase), ("fetch EC2", "instances", fetch_lookups_phase) ]
+	else:
+		listing_args = capture_aws_cli_args(module, "run_aws_cli", lambda: module["get_managed_instance_pages"](None, REGION))
+		lookup_args = capture_aws_cli_args(module, "run_aws_cli", lambda: module["get_ec2_instances"](None, REGION, [ "{instance_ids}" ]))
+
+		def get_lookup_args(instance_ids):
+			return [ arg.replace("[\"{instance_ids}\"]", json.dumps(instance_ids)) for arg in lookup_args ]
+
+		def fetch_phase(state):
+			state["payload"] = fetch(listing_args)
+			return len(state["payload"])
+
+		def parse_phase(state):
+			state["managed_instances"] = json.loads(state["payload"]).get("InstanceInformationList", [ ])
+			return len(state["managed_instances"])
+
+		def fetch_lookups_phase(state):
+			# The batches are fetched at the same time, like the script does
+			with concurrent.futures.ThreadPoolExecutor(max_workers=module["MAX_WORKERS"]) as executor:
+				state["lookup_payloads"] = list(executor.map(lambda batch: fetch(get_lookup_args(batch)), get_lookup_batches(module, [ state["managed_instances"] ])))
+
+			return sum(len(payload) for payload in state["lookup_payloads"])
+
+		def parse_lookups_phase(state):
+			state["ec2_instances"] = { }
+
+			for payload in state["lookup_payloads"]:
+				for instance in json.loads(payload) or [ ]:
+					state["ec2_instances"][instance["InstanceId"]] = instance
+
+			return len(state["ec2_instances"])
+
+		fetch_phases = [ ("fetch", "bytes", fetch_phase), ("parse", "instances", parse_phase), ("fetch EC2", "bytes", fetch_lookups_phase), ("parse EC2", "instances", parse_lookups_phase) ]
+
+	def convert_phase(state):
+		state["connections"] = [ module["get_connection"](instance, state["ec2_instances"].get(instance.get("InstanceId", ""), { })) for instance in state["managed_instances"] ]
+		return len(state["connections"])
+
+	def serialize_phase(state):
+		return len(json.dumps({ "Objects": state["connections"] }))
+
+	return fetch_phases + [ ("convert", "connections", convert_phase), ("serialize", "bytes", serialize_phase) ]
+
+
+def run_phases(phases, trace_memory):
+	# Returns the duration, the peak of the memory allocated by Python (if traced) and the
+	# size of the result of every phase. The state of earlier phases is kept, as in the script.
+	state = { }
+	results = [ ]
+
+	if trace_memory:
+		tracemalloc.start()
+
+	try:
+		for name, unit, phase in phases:
+			if trace_memory:
+				tracemalloc.reset_peak()
+				baseline, _ = tracemalloc.get_traced_memory()
+
+			started = time.perf_counter()
+			size = phase(state)
+			duration = time.perf_counter() - started
+
+			peak = None
+
+			if trace_memory:
+				_, peak = tracemalloc.get_traced_memory()
+				peak = (peak - baseline) / 1024 / 1024
+
+			results.append((name, unit, duration, peak, size))
+	finally:
+		if trace_memory:
+			tracemalloc.stop()
+
+	return results
+
+
+def run_script(script_path, output_path, environment):
+	# Runs the whole script like Royal TS does and returns the duration and the peak RSS.
+	# The output is written to a file, which is checked by the phases process.
+	with open(output_path, "wb") as stdout_file, tempfile.TemporaryFile() as stderr_file:
+		started = time.monotonic()
+		process = subprocess.Popen([sys.executable, script_path], stdout=stdout_file, stderr=stderr_file, env=environment)
+
+		# wait4() reports the resource usage of exactly this child, including its peak RSS
+		_, status, usage = os.wait4(process.pid, 0)
+		process.returncode = os.waitstatus_to_exitcode(status)
+		duration = time.monotonic() - started
+
+		stderr_file.seek(0)
+		stderr = stderr_file.read().decode(errors="replace")
+
+	if process.returncode != 0:
+		raise RuntimeError("The script failed:\n" + stderr)
+
+	# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+	peak_rss = usage.ru_maxrss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+	return duration, peak_rss
+
+
+def check_output(name, seed, count, output_path):
+	# Every instance has to show up with the name from its tags
+	with open(output_path, "rb") as output_file:
+		objects = json.load(output_file)["Objects"]
+
+	if len(objects) != count:
+		raise RuntimeError(name + " returned " + str(len(objects)) + " connections instead of " + str(count))
+
+	for connection in objects[:100]:
+		if not connection["ID"].startswith("i-"):
+			continue
+
+		instance = make_instance(seed, get_instance_index(connection["ID"]))
+		names = [ tag["Value"] for tag in instance.get("Tags", [ ]) if tag["Key"] == "Name" ]
+
+		if names and connection["Name"] != names[0]:
+			raise RuntimeError(name + " named " + connection["ID"] + " \"" + connection["Name"] + "\" instead of \"" + names[0] + "\"")
+
+
+def benchmark_phases(name, backend, seed, count, output_path, trace_memory):
+	# Runs in a process of its own (see run_phases_process()) and prints the rows of the phases
+	check_output(name, seed, count, output_path)
+
+	module = load_module(name, load_script(name))
+	phases = get_ssm_phases(module, backend) if name == "ssm" else get_ec2_phases(module, backend)
+
+	timings = run_phases(phases, False)
+	memory = run_phases(phases, True) if trace_memory else [ (None, None, None, None, None) ] * len(timings)
+	rows = [ ]
+
+	for (phase, unit, duration, _, size), (_, _, _, peak, _) in zip(timings, memory):
+		rows.append({
+			"Script": name,
+			"Backend": backend,
+			"Instances": count,
+			"Phase": phase,
+			"Duration (s)": round(duration, 3),
+			"Peak (MB)": round(peak, 1) if peak is not None else "-",
+			"Size": str(size) + " " + unit
+		})
+
+	print(json.dumps(rows))
+
+
+def run_phases_process(name, backend, seed, count, output_path, trace_memory, environment):
+	# The phases hold the whole fleet in memory. They run in a separate process, so that the
+	# benchmark itself stays small: the peak RSS of a child process includes the memory of its
+	# parent at the time it was forked.
+	cmd = [ sys.executable, os.path.abspath(__file__), "--phases", name, "--backends", backend, "--sizes", str(count), "--seed", str(seed), "--output", output_path ]
+
+	if not trace_memory:
+		cmd.append("--no-memory")
+
+	return json.loads(subprocess.run(cmd, stdout=subprocess.PIPE, check=True, env=environment).stdout)
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(description="Benchmark the AWS EC2 and AWS EC2 SSM Dynamic Folder scripts against synthetic fleets.")
+	parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated numbers of instances (default: 1000,10000,100000)")
+	parser.add_argument("--scripts", default=",".join(SCRIPTS), help="comma-separated scripts to benchmark (default: " + ",".join(SCRIPTS) + ")")
+	parser.add_argument("--backends", help="comma-separated code paths to benchmark: cli (AWS CLI) and sdk (boto3) (default: both, or cli if boto3 isn't installed)")
+	parser.add_argument("--seed", type=int, default=1, help="seed for generating the instances (default: 1)")
+	parser.add_argument("--no-memory", action="store_true", help="skip the second pass that traces the memory usage of every phase")
+	parser.add_argument("--json", action="store_true", help="print the results as JSON")
+
+	# Used by run_phases_process()
+	parser.add_argument("--phases", help=argparse.SUPPRESS)
+	parser.add_argument("--output", help=argparse.SUPPRESS)
+
+	return parser.parse_args()
+
+
+def main():
+	args = parse_arguments()
+
+	if args.phases:
+		benchmark_phases(args.phases, args.backends, args.seed, int(args.sizes), args.output, not args.no_memory)
+		return
+
+	if sys.platform == "win32":
+		sys.exit("The benchmark needs an executable stub on PATH and os.wait4(), which aren't available on Windows.")
+
+	names = [ name.strip() for name in args.scripts.split(",") ]
+	unknown_names = [ name for name in names if name not in SCRIPTS ]
+
+	if unknown_names:
+		sys.exit("Unknown scripts: " + ", ".join(unknown_names))
+
+	if args.backends:
+		backends = [ backend.strip() for backend in args.backends.split(",") ]
+		unknown_backends = [ backend for backend in backends if backend not in BACKENDS ]
+
+		if unknown_backends:
+			sys.exit("Unknown backends: " + ", ".join(unknown_backends))
+
+		if "sdk" in backends and importlib.util.find_spec("boto3") is None:
+			sys.exit("The sdk backend needs boto3, which isn't installed.")
+	else:
+		backends = [ backend for backend in BACKENDS if backend != "sdk" or importlib.util.find_spec("boto3") is not None ]
+
+	results = [ ]
+	endpoint = StubEndpoint(args.seed)
+	threading.Thread(target=endpoint.serve_forever, daemon=True).start()
+
+	with tempfile.TemporaryDirectory() as directory:
+		install_stub(directory)
+		os.environ["BENCHMARK_PAYLOAD_DIR"] = directory
+		os.environ["BENCHMARK_SEED"] = str(args.seed)
+
+		environments = { backend: get_environment(backend, directory, endpoint) for backend in backends }
+		output_path = os.path.join(directory, "output.json")
+
+		# The directory of a script comes first on its module search path, so the scripts are kept
+		# away from the boto3 module of the stub
+		script_directory = os.path.join(directory, "scripts")
+		os.mkdir(script_directory)
+
+		for size in args.sizes.split(","):
+			count = int(size)
+
+			started = time.monotonic()
+			write_payloads(directory, args.seed, count)
+			endpoint.count = count
+
+			if not args.json:
+				print("Generated " + str(count) + " instances in " + str(round(time.monotonic() - started, 1)) + " s", file=sys.stderr)
+
+			for name in names:
+				script_path = os.path.join(script_directory, name + ".py")
+
+				with open(script_path, "w", encoding="utf-8") as script_file:
+					script_file.write(load_script(name))
+
+				for backend in backends:
+					duration, peak_rss = run_script(script_path, output_path, environments[backend])
+
+					for row in run_phases_process(name, backend, args.seed, count, output_path, not args.no_memory, environments[backend]):
+						add_row(results, args.json, row)
+
+					add_row(results, args.json, {
+						"Script": name,
+						"Backend": backend,
+						"Instances": count,
+						"Phase": "total",
+						"Duration (s)": round(duration, 3),
+						"Peak (MB)": round(peak_rss, 1),
+						"Size": str(os.path.getsize(output_path)) + " bytes"
+					})
+
+	endpoint.shutdown()
+
+	if args.json:
+		print(json.dumps(results, indent=4))
+
+
+COLUMNS = ["Script", "Backend", "Instances", "Phase", "Duration (s)", "Peak (MB)", "Size"]
+
+
+def add_row(results, as_json, row):
+	results.append(row)
+
+	if not as_json:
+		print_row(row, len(results) == 1)
+
+
+def print_row(row, header):
+	widths = [max(len(column), 14) for column in COLUMNS]
+
+	if header:
+		print("  ".join(column.ljust(width) for column, width in zip(COLUMNS, widths)))
+
+	print("  ".join(str(row.get(column, "-")).ljust(width) for column, width in zip(COLUMNS, widths)), flush=True)
+
+
+if __name__ == "__main__":
+	main()
@@ -8,12 +8,21 @@
 # </auto-generated>
 # ----------------------
 
+import concurrent.futures
+import ipaddress
 import subprocess
 import json
 import os
-import re
 import sys
 
+# the Hetzner Cloud API returns at most 50 servers per page
+PAGE_SIZE = 50
+# the pages after the first one are requested at the same time, at most this many at once
+MAX_WORKERS = 8
+# seconds to wait for a response of the API
+REQUEST_TIMEOUT = 30
+DEFAULT_API_URL = "https://api.hetzner.cloud/v1"
+
 # log_error will write the error to the stderr, so that Royal TS will display it.
 
 
@@ -22,27 +31,109 @@ def log_error(err):
     exit(1)
 
 
-def get_instances(api_key):
-    os.environ["HCLOUD_TOKEN"] = api_key
-    cmd = "hcloud"
-    store = {
-        "Objects": []
-    }
-    # get servers
+def get_api_url(api_url):
+    # the HCLOUD_ENDPOINT environment variable is used by the hcloud CLI as well
+    return (api_url.strip() or os.environ.get("HCLOUD_ENDPOINT") or DEFAULT_API_URL).rstrip("/")
+
+
+def get_session(api_key):
+    import requests
+
+    # all requests share one session, which keeps a connection alive for every worker
+    session = requests.Session()
+    session.headers["Authorization"] = "Bearer {}".format(api_key)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_page(session, api_url, page):
+    response = session.get("{}/servers".format(api_url), params={"page": page, "per_page": PAGE_SIZE}, timeout=REQUEST_TIMEOUT)
+    if response.status_code != 200:
+        # the API describes errors as {"error": {"code": ..., "message": ...}}
+        try:
+            message = response.json()["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            message = response.text
+        raise RuntimeError("HTTP {}: {}".format(response.status_code, message))
+    return response.json()
+
+
+def get_servers_api(api_key, api_url):
+    session = get_session(api_key)
+    # the first page tells how many pages there are, the remaining ones are requested at the same time
+    first_page = get_page(session, api_url, 1)
+    servers = first_page.get("servers") or []
+    pagination = (first_page.get("meta") or {}).get("pagination") or {}
+    last_page = pagination.get("last_page") or 1
+    if last_page > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(last_page - 1, MAX_WORKERS)) as executor:
+            for page in executor.map(lambda page: get_page(session, api_url, page), range(2, last_page + 1)):
+                servers += page.get("servers") or []
+    return servers
+
+
+def get_servers_cli(api_key, api_url):
+    env = dict(os.environ)
+    env["HCLOUD_TOKEN"] = api_key
+    env["HCLOUD_ENDPOINT"] = api_url
+    # hcloud prints the servers in the same structure as the API
     server_list_process = subprocess.Popen(
-        "{} server list -o columns=id,name,ipv4 -o noheader".format(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        ["hcloud", "server", "list", "-o", "json"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
     (stdout, stderr) = server_list_process.communicate()
     exit_code = server_list_process.wait()
     # check if hcloud returned a successful status code != 0
     if exit_code != 0:
-        log_error("could not get server list: {}".format(stderr.decode()))
+        raise RuntimeError(stderr.decode())
+    return json.loads(stdout) or []
+
+
+def get_computer_name(server):
+    public_net = server.get("public_net") or {}
+    ipv4 = public_net.get("ipv4") or {}
+    if ipv4.get("ip"):
+        return ipv4["ip"]
+    # servers without a public IPv4 address are reached on the first address of their IPv6 network
+    ipv6 = public_net.get("ipv6") or {}
+    if ipv6.get("ip"):
+        return str(ipaddress.ip_network(ipv6["ip"], strict=False)[1])
+    for private_net in server.get("private_net") or []:
+        if private_net.get("ip"):
+            return private_net["ip"]
+    return server.get("name", "")
+
+
+def get_instances(api_key, api_url="", backend="api"):
+    api_url = get_api_url(api_url)
+    backend = backend.strip().lower() or "api"
+    store = {
+        "Objects": []
+    }
+    # get servers
+    try:
+        if backend == "api":
+            try:
+                servers = get_servers_api(api_key, api_url)
+            except ImportError:
+                # without the requests module the servers are listed with the hcloud CLI, like before
+                try:
+                    servers = get_servers_cli(api_key, api_url)
+                except FileNotFoundError:
+                    log_error("the requests module or the hcloud CLI is needed, install requests with: pip install requests")
+        elif backend == "cli":
+            servers = get_servers_cli(api_key, api_url)
+        else:
+            log_error("unknown backend \"{}\", expected api or cli".format(backend))
+    except Exception as e:
+        # connection errors, HTTP errors, a missing hcloud binary etc.
+        log_error("could not get server list: {}".format(str(e)))
     # loop over the returned servers and build the royal ts JSON
-    for line in stdout.decode().strip().splitlines():
-        values = re.findall(r"[^ ]+", line)
+    for server in servers:
         store["Objects"].append({
-            "ID": values[0],
-            "Name": values[1],
-            "ComputerName": values[2],
+            "ID": str(server["id"]),
+            "Name": server.get("name", ""),
+            "ComputerName": get_computer_name(server),
             "Username": "root",
             "Type": "TerminalConnection",
             "TerminalConnectionType": "SSH",
@@ -51,4 +142,4 @@ def get_instances(api_key):
     return json.dumps(store)
 
 
-print(get_instances("$CustomProperty.APIKey$"))
+print(get_instances("$CustomProperty.APIKey$", "$CustomProperty.APIURL$", "$CustomProperty.Backend$"))
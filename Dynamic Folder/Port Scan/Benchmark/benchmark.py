@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+# Loopback benchmark for the Port Scan Dynamic Folder script.
+#
+# Starts listeners on 127.x.y.z addresses with a known mix of open, closed and
+# blackholed (dropped) ports, runs the script against them with every scan backend
+# and reports throughput, peak memory usage and accuracy. Runs offline on Linux.
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import resource
+import selectors
+import subprocess
+import tempfile
+import threading
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RDFE_PATH = os.path.join(SCRIPT_DIR, "..", "Port Scan (Python).rdfe")
+
+# Loopback subnets that are free of real services, so every answer comes from a benchmark listener
+SCENARIOS = {
+	"/24": "127.42.0.0/24",
+	"/20": "127.43.0.0/20"
+}
+
+BACKENDS = ["is_port_open", "serial", "selectors", "asyncio"]
+
+PORT_PROPERTIES = {
+	22: "SSH",
+	80: "HTTP",
+	443: "HTTPS",
+	3389: "RDP",
+	5900: "VNC"
+}
+
+# Inserted in front of the config block of the script and called instead of get_connections()
+# to reproduce the original scan loop: one blocking is_port_open() call per address and port.
+# is_port_open() is the original probe, which the script doesn't ship anymore.
+SERIAL_LOOP = """
+def is_port_open(target, port):
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.settimeout(SOCKET_TIMEOUT)
+
+	result = sock.connect_ex((target, port))
+
+	sock.close()
+
+	if (result == 0):
+		return True
+
+	return False
+
+
+def get_connections_is_port_open(config):
+	connections = [ ]
+	ports = get_ports_to_scan(config)
+
+	for ips in get_ranges_to_scan(config):
+		for target in ips:
+			for port in ports:
+				if is_port_open(int_to_ip(target), port):
+					connections.append({ "ComputerName": int_to_ip(target), "Port": port })
+
+	return json.dumps({ "Objects": connections })
+
+"""
+
+
+def load_script():
+	# The .rdfe file is the source of truth for the script and the default custom property values
+	with open(RDFE_PATH, "r", encoding="utf-8") as rdfe_file:
+		folder = json.load(rdfe_file)["Objects"][0]
+
+	properties = { }
+
+	for prop in folder["CustomProperties"]:
+		if prop["Type"] != "Header":
+			properties[prop["Name"].replace(" ", "")] = prop["Value"]
+
+	return folder["Script"], properties
+
+
+def render_script(script, properties, backend):
+	script = re.sub(r"\$CustomProperty\.(\w+)\$", lambda match: str(properties.get(match.group(1), "")), script)
+
+	if backend == "is_port_open":
+		definitions, separator, main = script.rpartition("\nconfig = {")
+
+		if not separator or "print(get_connections(config))" not in main:
+			raise ValueError("Unexpected structure of the script")
+
+		script = definitions + SERIAL_LOOP + separator + main.replace("print(get_connections(config))", "print(get_connections_is_port_open(config))")
+
+	return script
+
+
+def get_addresses(cidr):
+	network, prefix = cidr.split("/")
+	first = ip_to_int(network) + 1
+	count = 2 ** (32 - int(prefix)) - 2
+
+	return [socket.inet_ntoa((first + offset).to_bytes(4, "big")) for offset in range(count)]
+
+
+def ip_to_int(ip):
+	return int.from_bytes(socket.inet_aton(ip), "big")
+
+
+class Listeners:
+	# Open ports accept connections on a background thread. Blackholed ports listen with
+	# a backlog of zero that is filled up right away, so the kernel drops further SYNs.
+	# Every other port is closed and answered with a RST.
+
+	def __init__(self, addresses, ports, open_ratio, blackholed_ratio, seed):
+		self.truth = { }
+		self.sockets = [ ]
+		self.selector = selectors.DefaultSelector()
+		self.stopped = threading.Event()
+
+		rng = random.Random(seed)
+
+		for address in addresses:
+			for port in ports:
+				draw = rng.random()
+
+				if draw < open_ratio:
+					self.truth[(address, port)] = "open"
+					self.selector.register(self.listen(address, port, 128), selectors.EVENT_READ)
+				elif draw < open_ratio + blackholed_ratio:
+					self.truth[(address, port)] = "blackholed"
+					self.listen(address, port, 0)
+
+					filler = socket.create_connection((address, port), 1)
+					self.sockets.append(filler)
+				else:
+					self.truth[(address, port)] = "closed"
+
+		self.thread = threading.Thread(target=self.accept, daemon=True)
+		self.thread.start()
+
+	def listen(self, address, port, backlog):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.bind((address, port))
+		sock.listen(backlog)
+
+		self.sockets.append(sock)
+
+		return sock
+
+	def accept(self):
+		while not self.stopped.is_set():
+			for key, _ in self.selector.select(0.1):
+				try:
+					connection, _ = key.fileobj.accept()
+					connection.close()
+				except OSError:
+					pass
+
+	def count(self, state):
+		return sum(1 for value in self.truth.values() if value == state)
+
+	def close(self):
+		self.stopped.set()
+		self.thread.join()
+		self.selector.close()
+
+		for sock in self.sockets:
+			sock.close()
+
+
+def run_backend(script, properties, backend, timeout):
+	# Returns the duration, the open ports found, the diagnostics output and the peak RSS
+	# of the run, or None if it did not finish within the timeout
+	if backend != "is_port_open":
+		properties = dict(properties, ScanEngine=backend)
+
+	with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as script_file:
+		script_file.write(render_script(script, properties, backend))
+
+	try:
+		with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+			started = time.monotonic()
+
+			process = subprocess.Popen([sys.executable, script_file.name], stdout=stdout_file, stderr=stderr_file)
+			killer = threading.Timer(timeout, process.kill)
+			killer.start()
+
+			# wait4() reports the resource usage of exactly this child, including its peak RSS
+			_, status, usage = os.wait4(process.pid, 0)
+			process.returncode = os.waitstatus_to_exitcode(status)
+
+			duration = time.monotonic() - started
+			timed_out = not killer.is_alive()
+			killer.cancel()
+
+			stdout_file.seek(0)
+			stderr_file.seek(0)
+
+			stdout = stdout_file.read()
+			stderr = stderr_file.read().decode(errors="replace")
+	finally:
+		os.unlink(script_file.name)
+
+	if timed_out:
+		return None
+
+	if process.returncode != 0:
+		raise RuntimeError(backend + " failed:\n" + stderr)
+
+	found = set((obj["ComputerName"], obj["Port"]) for obj in json.loads(stdout)["Objects"])
+
+	# ru_maxrss is in kilobytes on Linux
+	return duration, found, stderr, usage.ru_maxrss / 1024
+
+
+def get_accuracy(truth, found):
+	expected = set(key for key, state in truth.items() if state == "open")
+
+	return len(expected & found), len(expected - found), len(found - expected)
+
+
+def raise_open_files_limit():
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+	if soft != hard:
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(description="Benchmark the Port Scan Dynamic Folder script against loopback listeners.")
+	parser.add_argument("--scenarios", default="/24,/20", help="comma-separated scenarios (" + ", ".join(SCENARIOS) + ") or subnets in 127.0.0.0/8 (default: /24,/20)")
+	parser.add_argument("--backends", default=",".join(BACKENDS), help="comma-separated backends to compare (default: " + ",".join(BACKENDS) + ")")
+	parser.add_argument("--ports", default="22,80,443,3389,5900", help="comma-separated ports out of " + ", ".join(str(port) for port in PORT_PROPERTIES) + " (default: all)")
+	parser.add_argument("--open", type=float, default=0.05, help="ratio of open ports (default: 0.05)")
+	parser.add_argument("--blackholed", type=float, default=0.01, help="ratio of blackholed ports (default: 0.01)")
+	parser.add_argument("--seed", type=int, default=1, help="seed for distributing the port states (default: 1)")
+	parser.add_argument("--run-timeout", type=float, default=600, help="give up on a single run after this many seconds (default: 600)")
+	parser.add_argument("--property", action="append", default=[ ], metavar="NAME=VALUE", help="override a custom property of the script, e.g. Timeout=0.5 (repeatable)")
+	parser.add_argument("--diagnostics", action="store_true", help="print the diagnostics of every run")
+	parser.add_argument("--json", action="store_true", help="print the results as JSON")
+
+	return parser.parse_args()
+
+
+def main():
+	args = parse_arguments()
+
+	if not sys.platform.startswith("linux"):
+		sys.exit("The benchmark needs Linux, where every 127.x.y.z address is routed to the loopback interface.")
+
+	ports = [int(port) for port in args.ports.split(",")]
+	unknown_ports = [port for port in ports if port not in PORT_PROPERTIES]
+
+	if unknown_ports:
+		sys.exit("The script only scans the ports " + ", ".join(str(port) for port in PORT_PROPERTIES) + ".")
+
+	script, properties = load_script()
+
+	properties.update({
+		"Interfaces": "none",
+		"ExcludeSubnets": "",
+		"CacheTTL": "0",
+		"Fingerprint": "false",
+		"ReverseDNS": "false",
+		"Diagnostics": "true" if args.diagnostics else "false"
+	})
+
+	for port, name in PORT_PROPERTIES.items():
+		properties[name] = "true" if port in ports else "false"
+
+	for override in args.property:
+		name, _, value = override.partition("=")
+		properties[name.replace(" ", "")] = value
+
+	raise_open_files_limit()
+
+	results = [ ]
+
+	for scenario in args.scenarios.split(","):
+		cidr = SCENARIOS.get(scenario.strip(), scenario.strip())
+		addresses = get_addresses(cidr)
+
+		try:
+			listeners = Listeners(addresses, ports, args.open, args.blackholed, args.seed)
+		except PermissionError:
+			sys.exit("Binding ports below 1024 needs root or a lower net.ipv4.ip_unprivileged_port_start.")
+
+		try:
+			for backend in args.backends.split(","):
+				backend = backend.strip()
+				result = run_backend(script, dict(properties, IncludeSubnets=cidr), backend, args.run_timeout)
+
+				row = {
+					"Subnet": cidr,
+					"Backend": backend,
+					"Hosts": len(addresses),
+					"Probes": len(addresses) * len(ports),
+					"Open": listeners.count("open"),
+					"Blackholed": listeners.count("blackholed")
+				}
+
+				if result:
+					duration, found, diagnostics, peak_rss = result
+					correct, missed, false_open = get_accuracy(listeners.truth, found)
+
+					row.update({
+						"Duration (s)": round(duration, 3),
+						"Hosts/s": round(len(addresses) / duration, 1),
+						"Probes/s": round(len(addresses) * len(ports) / duration, 1),
+						"Peak RSS (MB)": round(peak_rss, 1),
+						"Found": correct,
+						"Missed": missed,
+						"False open": false_open,
+						"Accuracy (%)": round(100.0 * correct / max(1, correct + missed + false_open), 2)
+					})
+
+					if args.diagnostics:
+						print(backend + " @ " + cidr + ":\n" + diagnostics, file=sys.stderr)
+				else:
+					row["Duration (s)"] = "timeout"
+
+				results.append(row)
+
+				if not args.json:
+					print_row(row, len(results) == 1)
+		finally:
+			listeners.close()
+
+	if args.json:
+		print(json.dumps(results, indent=4))
+
+
+COLUMNS = ["Subnet", "Backend", "Probes", "Duration (s)", "Hosts/s", "Probes/s", "Peak RSS (MB)", "Found", "Missed", "False open", "Accuracy (%)"]
+
+
+def print_row(row, header):
+	widths = [max(len(column), 14) for column in COLUMNS]
+
+	if header:
+		print("  ".join(column.ljust(width) for column, width in zip(COLUMNS, widths)))
+
+	print("  ".join(str(row.get(column, "-")).ljust(width) for column, width in zip(COLUMNS, widths)), flush=True)
+
+
+if __name__ == "__main__":
+	main()
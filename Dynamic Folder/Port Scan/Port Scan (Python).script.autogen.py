@@ -9,18 +9,115 @@
 # ----------------------
 
 import sys
+import os
 import struct
 import json
 import socket
-
-import netifaces
-from netifaces import *
+import asyncio
+import selectors
+import errno
+import time
+import collections
+import concurrent.futures
+import functools
+import ssl
+import threading
+import queue
+import random
+import math
+import bisect
+import hashlib
 
 
 ENABLE_LOGGING = False
 
 SOCKET_TIMEOUT = $CustomProperty.Timeout$
 
+# Linux ioctls to read the IPv4 address and netmask of an interface, and the "up" flag of routes
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+RTF_UP = 0x1
+RTF_REJECT = 0x200
+
+# IPv6 targets are stored above the IPv4 address space: the 128 address bits, a marker bit that
+# keeps addresses like ::1 apart from IPv4 ones, and above it the scope (interface index) that
+# link-local addresses need to be reachable
+IPV6_ADDRESS_MASK = (1 << 128) - 1
+IPV6_MARKER = 1 << 128
+IPV6_SCOPE_SHIFT = 129
+
+# Netlink messages and attributes to dump the kernel's IPv6 neighbour cache on Linux
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_INCOMPLETE = 0x01
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+
+# How long IPv6 discovery waits for answers to the all-nodes multicast ping
+IPV6_DISCOVERY_TIMEOUT = 1.0
+
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK))
+CONNECT_REFUSED = (errno.ECONNREFUSED, getattr(errno, "WSAECONNREFUSED", errno.ECONNREFUSED))
+
+# Running out of file descriptors or socket buffers says nothing about the probed port,
+# so these probes are retried with less concurrency instead of being reported as unanswered
+RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, getattr(errno, "WSAEMFILE", errno.EMFILE), getattr(errno, "WSAENOBUFS", errno.ENOBUFS))
+RESOURCE_ERROR_BACKOFF = 0.1
+RESOURCE_ERROR_RETRIES = 8
+
+# A probe is "open" when the handshake completed and "closed" when the host actively
+# refused it. Probes that time out or fail otherwise are not reported at all.
+PORT_OPEN = "open"
+PORT_CLOSED = "closed"
+
+# The adaptive timeout is the 99th percentile of the measured round-trip times times a
+# safety factor, but never less than the floor and never more than SOCKET_TIMEOUT
+ADAPTIVE_TIMEOUT_FACTOR = 3.0
+ADAPTIVE_TIMEOUT_FLOOR = 0.05
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 8
+
+# Round-trip times are counted in a histogram whose buckets grow by this factor (about 9%),
+# starting at the upper edge of the first bucket. The percentile is read from the bucket edges.
+RTT_BUCKET_FACTOR = 2 ** (1 / 8)
+RTT_BUCKET_FIRST = 0.0001
+
+# Adaptive concurrency halves the number of connection attempts in flight when a port that
+# answered before stops answering, when sockets run out or when the short-term average RTT
+# rises well above the long-term one. Otherwise it grows by one per window of answered probes.
+CONCURRENCY_DECREASE_FACTOR = 0.5
+RTT_INFLATION_FACTOR = 3.0
+RTT_INFLATION_MIN = 0.02
+
+# Filtered ports time out on hosts that answer on other ports, so timeouts only count as dropped
+# packets when the short-term share of them on a port rises this far above its long-term share
+LOSS_RATE_MARGIN = 0.3
+LOSS_RATE_MIN_SAMPLES = 16
+
+# How long fingerprinting waits for a server greeting and then for the answer to a TLS ClientHello
+BANNER_TIMEOUT = 0.5
+FINGERPRINT_TIMEOUT = 1.0
+
+# Reverse DNS lookups run on at most this many threads, and a single lookup is given up after
+# the timeout. Failed lookups are cached for a shorter time than resolved names.
+DNS_WORKERS = 16
+DNS_LOOKUP_TIMEOUT = 2.0
+DNS_NEGATIVE_CACHE_TTL = 600
+
+# With "Resume Scans" enabled, the progress is saved at least this often (in seconds).
+# Checkpoints older than the maximum age are not resumed.
+CHECKPOINT_INTERVAL = 30
+CHECKPOINT_MAX_AGE = 86400
+
+# The probes done for the cache and the checkpoint are marked in bitmaps of this many bits
+# per port (as a power of two), one for every block of addresses that has been probed
+PROBE_BLOCK_BITS = 12
+
 PORT_MAPPINGS = {
 	22: {
 		"Type": "TerminalConnection",
@@ -45,116 +142,2204 @@ PORT_MAPPINGS = {
 }
 
 
+# Connection types for protocols identified by fingerprinting; they take precedence over PORT_MAPPINGS
+PROTOCOL_MAPPINGS = {
+	"ssh": {
+		"Type": "TerminalConnection",
+		"NamePostfix": " - SSH"
+	},
+	"http": {
+		"Type": "WebConnection",
+		"NamePostfix": " - HTTP"
+	},
+	"https": {
+		"Type": "WebConnection",
+		"NamePostfix": " - HTTPS"
+	},
+	"vnc": {
+		"Type": "VNCConnection",
+		"NamePostfix": " - VNC"
+	},
+	"rdp": {
+		"Type": "RemoteDesktopConnection",
+		"NamePostfix": " - RDP"
+	}
+}
+
+
 def get_prefix(subnet_mask):
     prefix = sum([bin(int(x)).count('1') for x in subnet_mask.split('.')])
 
     return prefix
 
 
+def ip_to_int(ip):
+    if ":" in ip:
+        # IPv6, optionally with the scope of a link-local address ("fe80::1%eth0")
+        address, _, scope = ip.partition("%")
+        return get_ipv6_target(socket.inet_pton(socket.AF_INET6, address), get_scope_id(scope) if scope else 0)
+
+    return struct.unpack('>I', socket.inet_aton(ip))[0]  # note the endianness
+
+
+def int_to_ip(address):
+    if is_ipv6(address):
+        ip = socket.inet_ntop(socket.AF_INET6, (address & IPV6_ADDRESS_MASK).to_bytes(16, "big"))
+        scope_id = address >> IPV6_SCOPE_SHIFT
+        return ip + "%" + get_scope_name(scope_id) if scope_id else ip
+
+    return socket.inet_ntoa(struct.pack('>I', address))
+
+
+def is_ipv6(target):
+	return target > 0xFFFFFFFF
+
+
+def get_ipv6_target(packed_address, scope_id):
+	# Only link-local addresses (fe80::/10) keep the scope, other addresses are the same on every interface
+	address = int.from_bytes(packed_address, "big") | IPV6_MARKER
+
+	if address >> 118 & 0x3FF == 0x3FA:
+		address |= scope_id << IPV6_SCOPE_SHIFT
+
+	return address
+
+
+def get_scope_id(scope):
+	return int(scope) if scope.isdigit() else socket.if_nametoindex(scope)
+
+
+@functools.lru_cache(maxsize=None)
+def get_scope_name(scope_id):
+	try:
+		return socket.if_indextoname(scope_id)
+	except OSError:
+		return str(scope_id)
+
+
+def get_socket_address(target, port):
+	# Returns the address family and the address to connect to
+	if is_ipv6(target):
+		ip = socket.inet_ntop(socket.AF_INET6, (target & IPV6_ADDRESS_MASK).to_bytes(16, "big"))
+		return socket.AF_INET6, (ip, port, 0, target >> IPV6_SCOPE_SHIFT)
+
+	return socket.AF_INET, (int_to_ip(target), port)
+
+
 def get_all_ips_in_subnet(ip, cidr):
+    # Addresses are enumerated lazily as integers; use int_to_ip() to convert them
     host_bits = 32 - cidr
-    i = struct.unpack('>I', socket.inet_aton(ip))[0]  # note the endianness
+    i = ip_to_int(ip)
     start = (i >> host_bits) << host_bits  # clear the host bits
     end = start | ((1 << host_bits) - 1)
 
-    ips = []
+    # excludes the network and broadcast address, except for /31 point-to-point
+    # links (RFC 3021) and /32 host routes which have neither
+    if host_bits > 1:
+        start += 1
+        end -= 1
 
-    # excludes the first and last address in the subnet
-    for i in range(start, end):
-        ips.append(socket.inet_ntoa(struct.pack('>I', i)))
+    return range(start, end + 1)
 
-    return ips
 
+def get_cidr_range(cidr_text, hosts_only=True):
+	# Accepts "a.b.c.d/prefix" or a single address, which may also be an IPv6 address
+	ip, _, prefix = cidr_text.partition("/")
 
-def is_port_open(target, port):
-	sock = socket.socket(AF_INET, socket.SOCK_STREAM)
-	sock.settimeout(SOCKET_TIMEOUT)
+	if ":" in ip:
+		try:
+			target = ip_to_int(ip)
+		except (ValueError, OSError):
+			raise ValueError("Invalid address: " + cidr_text)
 
-	result = sock.connect_ex((target, port))
+		# IPv6 subnets are far too large to be scanned address by address
+		if prefix and prefix != "128":
+			raise ValueError("Only single IPv6 addresses are supported: " + cidr_text)
 
-	sock.close()
+		return range(target, target + 1)
 
-	if (result == 0):
-		return True
+	try:
+		cidr = int(prefix) if prefix else 32
+		ip_to_int(ip)
+	except (ValueError, OSError):
+		raise ValueError("Invalid subnet: " + cidr_text)
 
-	return False
+	if not 0 <= cidr <= 32:
+		raise ValueError("Invalid subnet: " + cidr_text)
 
+	if hosts_only:
+		return get_all_ips_in_subnet(ip, cidr)
 
-def create_connection(object_type, name_postfix, host, port):
-	name = host
+	host_bits = 32 - cidr
+	start = (ip_to_int(ip) >> host_bits) << host_bits
 
-	if name_postfix:
-		name += name_postfix
+	return range(start, start + (1 << host_bits))
 
-	connection = {
-		"Type": object_type,
-		"Name": name,
-		"ComputerName": host,
-		"Port": port,
-		"Path": "/" + host
-	}
 
-	return connection
+def merge_ranges(ranges):
+	# Sorts the ranges and joins overlapping or adjacent ones, so no address is contained twice
+	merged = [ ]
 
+	for address_range in sorted((r for r in ranges if len(r) > 0), key=lambda r: r.start):
+		if merged and address_range.start <= merged[-1].stop:
+			if address_range.stop > merged[-1].stop:
+				merged[-1] = range(merged[-1].start, address_range.stop)
+		else:
+			merged.append(address_range)
 
-def parse_potential_string_bool(potential_bool):
-	actual_bool = False
-	
-	if isinstance(potential_bool, bool):
-		actual_bool = potential_bool
-	elif isinstance(potential_bool, str):
-		potential_bool = potential_bool.lower()
-		if potential_bool == "true" or potential_bool == "yes":
-			actual_bool = True
+	return merged
 
-	return actual_bool
 
+def subtract_ranges(ranges, excluded_ranges):
+	# Both lists must be merged, i.e. sorted and free of overlaps
+	remaining = [ ]
 
-def get_connections(config):
-	iface_name = netifaces.gateways()["default"][netifaces.AF_INET][1]
+	for address_range in ranges:
+		start = address_range.start
 
-	addresses = [i['addr'] for i in ifaddresses(iface_name).setdefault(AF_INET, [{"addr": ""}] )]
-	netmasks = [i['netmask'] for i in ifaddresses(iface_name).setdefault(AF_INET, [{"addr": ""}] )]
+		for excluded in excluded_ranges:
+			if excluded.stop <= start or excluded.start >= address_range.stop:
+				continue
 
-	ip = addresses[0]
-	netmask = netmasks[0]
-	cidr = get_prefix(netmask)
+			if excluded.start > start:
+				remaining.append(range(start, excluded.start))
 
-	ips = get_all_ips_in_subnet(ip, cidr)
+			start = max(start, excluded.stop)
 
-	connections = [ ]
+		if start < address_range.stop:
+			remaining.append(range(start, address_range.stop))
 
-	for target_to_scan in ips:
-		if ENABLE_LOGGING:
-			print("Scanning " + target_to_scan + "...")
+	return remaining
 
-		for port_to_scan, props in PORT_MAPPINGS.items():
-			if port_to_scan == 22 and not config["ssh"]:
-				continue
 
-			if port_to_scan == 3389 and not config["rdp"]:
-				continue
+def get_default_interface_linux():
+	# The default route has destination and mask 0.0.0.0; prefer the one with the lowest metric
+	default_routes = [ ]
+
+	with open("/proc/net/route") as route_table:
+		next(route_table, None)
 
-			if port_to_scan == 5900 and not config["vnc"]:
+		for line in route_table:
+			fields = line.split()
+
+			if len(fields) < 8 or fields[1] != "00000000" or fields[7] != "00000000":
 				continue
 
-			if port_to_scan == 80 and not config["http"]:
+			if int(fields[3], 16) & RTF_UP:
+				default_routes.append((int(fields[6]), fields[0]))
+
+	return min(default_routes)[1] if default_routes else None
+
+
+def get_interface_addresses_linux(mode):
+	# Reads the primary IPv4 address of the interfaces from the kernel, which is much
+	# faster than loading netifaces. Secondary addresses of an interface are not seen.
+	import fcntl
+
+	if mode == "all":
+		iface_names = [iface_name for index, iface_name in socket.if_nameindex()]
+	else:
+		iface_names = [get_default_interface_linux()]
+
+	addresses = [ ]
+
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+		for iface_name in iface_names:
+			if not iface_name:
 				continue
 
-			if port_to_scan == 443 and not config["https"]:
+			request = struct.pack("256s", iface_name.encode()[:15])
+
+			try:
+				ip = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)[20:24]
+				netmask = fcntl.ioctl(sock.fileno(), SIOCGIFNETMASK, request)[20:24]
+			except OSError:
+				# The interface has no IPv4 address
 				continue
 
-			if is_port_open(target_to_scan, port_to_scan):
-				object_type = props["Type"]
-				name_postfix = props["NamePostfix"]
+			addresses.append((socket.inet_ntoa(ip), socket.inet_ntoa(netmask)))
+
+	return addresses
+
+
+def get_interface_addresses_netifaces(mode):
+	import netifaces
+
+	if mode == "all":
+		iface_names = netifaces.interfaces()
+	else:
+		iface_names = [netifaces.gateways()["default"][netifaces.AF_INET][1]]
+
+	addresses = [ ]
+
+	for iface_name in iface_names:
+		for address in netifaces.ifaddresses(iface_name).get(netifaces.AF_INET, [ ]):
+			addresses.append((address.get("addr", ""), address.get("netmask", "")))
+
+	return addresses
+
+
+def get_interface_ranges(mode):
+	if mode == "none":
+		return [ ]
+
+	# netifaces is only needed where the kernel can't be asked directly
+	if sys.platform.startswith("linux") and os.path.exists("/proc/net/route"):
+		addresses = get_interface_addresses_linux(mode)
+	else:
+		addresses = get_interface_addresses_netifaces(mode)
+
+	ranges = [ ]
+
+	for ip, netmask in addresses:
+		# Skip loopback and link-local networks
+		if not ip or not netmask or ip.startswith("127.") or ip.startswith("169.254."):
+			continue
+
+		ranges.append(get_all_ips_in_subnet(ip, get_prefix(netmask)))
+
+	return ranges
+
+
+def get_ranges_to_scan(config):
+	ranges = get_interface_ranges(config["interfaces"])
+	ranges.extend(get_cidr_range(cidr) for cidr in config["include"])
+
+	excluded_ranges = merge_ranges(get_cidr_range(cidr, False) for cidr in config["exclude"])
+
+	return subtract_ranges(merge_ranges(ranges), excluded_ranges)
+
+
+class AdaptiveTimeout:
+	# Tracks the round-trip times of answered probes (accepted or refused connections)
+	# and derives the connect timeout from them as the scan progresses. The samples are
+	# only counted in a histogram, so neither memory nor the cost of an update grows with the scan.
+
+	def __init__(self, upper_bound, adaptive=True):
+		self.upper_bound = upper_bound
+		self.adaptive = adaptive
+		self.timeout = upper_bound
+		self.buckets = [ ]
+		self.count = 0
+		self.p99 = None
+
+	def add_sample(self, rtt):
+		bucket = 0
+
+		if rtt > RTT_BUCKET_FIRST:
+			bucket = math.ceil(math.log(rtt / RTT_BUCKET_FIRST, RTT_BUCKET_FACTOR))
+
+		if bucket >= len(self.buckets):
+			self.buckets.extend([0] * (bucket + 1 - len(self.buckets)))
+
+		self.buckets[bucket] += 1
+		self.count += 1
+
+		if self.count < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+			return
+
+		# Re-evaluate often while the estimate is young and less often once it has settled
+		if self.count & (self.count - 1) == 0 or self.count % 1024 == 0:
+			self.update()
+
+	def update(self):
+		# The upper edge of the bucket that holds the 99th percentile
+		rank = int(self.count * 0.99)
+
+		for bucket, count in enumerate(self.buckets):
+			rank -= count
+
+			if rank < 0:
+				break
+
+		self.p99 = RTT_BUCKET_FIRST * RTT_BUCKET_FACTOR ** bucket
+
+		if self.adaptive:
+			self.timeout = min(self.upper_bound, max(ADAPTIVE_TIMEOUT_FLOOR, self.p99 * ADAPTIVE_TIMEOUT_FACTOR))
+
+
+class ConcurrencyController:
+	# Decides how many connection attempts may be in flight (AIMD) and paces their
+	# start through an optional token bucket that is shared by all scanned ranges
+	# and an optional minimum spacing between two probes to the same host.
+
+	def __init__(self, max_concurrency, timer, adaptive=True, bucket=None, host_spacing=0):
+		self.max_concurrency = max_concurrency
+		self.timer = timer
+		self.adaptive = adaptive
+		self.bucket = bucket
+		self.host_spacing = host_spacing
+		self.next_probe = { }
+		self.limit = float(max_concurrency)
+		self.throttles = 0
+		self.srtt = None
+		self.baseline_rtt = None
+		self.responsive = { }
+		self.answered = set()
+		self.loss_rates = { }
+		self.last_decrease = None
+
+	@property
+	def concurrency(self):
+		return max(1, int(self.limit))
+
+	def reserve(self, target):
+		# Returns how long to wait before the next connection attempt to target may be started
+		delay = self.bucket.reserve() if self.bucket else 0
+
+		if self.host_spacing:
+			now = time.monotonic()
+			start = max(now + delay, self.next_probe.get(target, 0))
+
+			self.next_probe[target] = start + self.host_spacing
+			delay = start - now
+
+		return delay
+
+	def is_due(self, target):
+		return self.next_probe.get(target, 0) <= time.monotonic()
+
+	def get_wait(self, targets):
+		# How long until the first of the given hosts may be probed again
+		return max(0, min(self.next_probe.get(target, 0) for target in targets) - time.monotonic())
+
+	def on_answer(self, target, port, rtt):
+		if target in self.responsive:
+			self.update_loss_rate(port, 0)
+
+		self.responsive.setdefault(target, time.monotonic())
+		self.answered.add((target, port))
+
+		if self.srtt is None:
+			self.srtt = self.baseline_rtt = rtt
+		else:
+			self.srtt += (rtt - self.srtt) / 8
+			self.baseline_rtt += (rtt - self.baseline_rtt) / 64
+
+		if self.srtt > self.baseline_rtt * RTT_INFLATION_FACTOR and self.srtt - self.baseline_rtt > RTT_INFLATION_MIN:
+			self.decrease()
+		elif self.adaptive:
+			self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+	def on_timeout(self, target, port, started):
+		# Silence from unknown addresses and from filtered ports is expected. Silence from a port
+		# that answered before is a sign of dropped packets, and so is a rising share of timeouts
+		# on a port of hosts that had already answered when the probe was sent.
+		if (target, port) in self.answered:
+			self.decrease()
+		elif self.responsive.get(target, started) < started and self.update_loss_rate(port, 1):
+			self.decrease()
+
+	def update_loss_rate(self, port, lost):
+		# Returns whether the short-term loss rate of the port is well above its long-term one
+		rates = self.loss_rates.get(port)
+
+		if rates is None:
+			rates = self.loss_rates[port] = [lost, lost, 0]
+		else:
+			rates[0] += (lost - rates[0]) / 16
+			rates[1] += (lost - rates[1]) / 128
+
+		rates[2] += 1
+
+		return rates[2] >= LOSS_RATE_MIN_SAMPLES and rates[0] > rates[1] + LOSS_RATE_MARGIN
+
+	def on_resource_error(self):
+		self.decrease()
+
+	def decrease(self):
+		now = time.monotonic()
+
+		# One congestion event usually hits many probes at once, so react at most once per timeout
+		if not self.adaptive or self.limit <= 1 or (self.last_decrease is not None and now - self.last_decrease < self.timer.timeout):
+			return
+
+		self.last_decrease = now
+		self.limit = max(1.0, self.limit * CONCURRENCY_DECREASE_FACTOR)
+		self.throttles += 1
+
+
+class TokenBucket:
+	# Limits the number of connection attempts per second. Callers reserve a token and
+	# sleep until it is due, so a negative balance is the queue of waiting callers.
+
+	def __init__(self, rate):
+		self.rate = rate
+		self.burst = max(1.0, rate / 10)
+		self.tokens = self.burst
+		self.updated = time.monotonic()
+		self.delayed = 0
+		self.lock = threading.Lock()
+
+	def reserve(self):
+		with self.lock:
+			now = time.monotonic()
+
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= 1
+
+			if self.tokens >= 0:
+				return 0
+
+			self.delayed += 1
+
+			return -self.tokens / self.rate
+
+
+class ScanCache:
+	# Remembers the probes of earlier scans between reloads. Answered probes are kept one by one,
+	# keyed by (address, port); all probes are kept as address ranges per port together with the
+	# time they were done. Probes younger than the TTL are served from the cache instead of being probed.
+	# The probes of the running scan are only collected and merged into the known ranges when the cache is saved.
+
+	def __init__(self, path, ttl):
+		self.path = path
+		self.ttl = ttl
+		self.now = time.time()
+		self.answered = { }
+		self.probed = { }
+		self.starts = { }
+		self.pending = { }
+		self.lock = threading.Lock()
+
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		del state["lock"]
+
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.lock = threading.Lock()
+
+	def load(self):
+		try:
+			with open(self.path, "r") as cache_file:
+				data = json.load(cache_file)
+
+			# Caches of older versions are just scanned again
+			if data.get("Version") != 2:
+				return
+
+			cutoff = self.now - self.ttl
+
+			for key, entry in data["Answered"].items():
+				if entry[1] < cutoff:
+					continue
+
+				ip, _, port = key.rpartition(":")
+				protocol = entry[2] if len(entry) > 2 else None
+
+				self.answered[(ip_to_int(ip), int(port))] = (entry[0], entry[1], protocol)
+
+			for port, runs in data["Probed"].items():
+				self.update_probed(int(port), [(range(start, stop), last_seen) for start, stop, last_seen in runs if last_seen >= cutoff])
+		except (OSError, ValueError, TypeError, KeyError):
+			# A missing or damaged cache just means everything gets scanned again
+			self.answered = { }
+			self.probed = { }
+			self.starts = { }
+
+	def save(self):
+		cutoff = self.now - self.ttl
+
+		with self.lock:
+			for port, ranges in self.pending.items():
+				self.update_probed(port, [(r, self.now) for r in merge_ranges(ranges)])
+
+			self.pending = { }
+			answered = { }
+
+			for (target, port), (state, last_seen, protocol) in self.answered.items():
+				if last_seen >= cutoff:
+					entry = [state, int(last_seen)]
+
+					if protocol:
+						entry.append(protocol)
+
+					answered[int_to_ip(target) + ":" + str(port)] = entry
+
+			probed = {str(port): [[r.start, r.stop, int(last_seen)] for r, last_seen in runs if last_seen >= cutoff] for port, runs in self.probed.items()}
+
+		write_json_file(self.path, { "Version": 2, "Answered": answered, "Probed": probed })
+
+	def update_probed(self, port, runs):
+		# The runs must be sorted and free of overlaps. They replace the parts of the known runs
+		# they overlap, and overlapping or adjacent runs of the same scan are joined into one.
+		starts = [r.start for r, last_seen in runs]
+		probed = [ ]
+
+		for address_range, last_seen in self.probed.get(port, [ ]):
+			first = max(0, bisect.bisect_right(starts, address_range.start) - 1)
+			last = bisect.bisect_left(starts, address_range.stop)
+			newer = [r for r, seen in runs[first:last] if seen != last_seen]
+
+			if newer:
+				probed.extend((r, last_seen) for r in subtract_ranges([address_range], newer))
+			else:
+				probed.append((address_range, last_seen))
+
+		probed.extend(runs)
+		probed.sort(key=lambda run: run[0].start)
+
+		joined = [ ]
+
+		for address_range, last_seen in probed:
+			if joined and joined[-1][1] == last_seen and joined[-1][0].stop >= address_range.start:
+				joined[-1] = (range(joined[-1][0].start, max(joined[-1][0].stop, address_range.stop)), last_seen)
+			else:
+				joined.append((address_range, last_seen))
+
+		self.probed[port] = joined
+		self.starts[port] = [r.start for r, last_seen in joined]
+
+	def get_fresh(self, ips):
+		# The states of the answered probes of the given addresses
+		with self.lock:
+			return {key: state for key, (state, last_seen, protocol) in self.answered.items() if key[0] in ips}
+
+	def is_fresh(self, probe):
+		target, port = probe
+
+		with self.lock:
+			starts = self.starts.get(port)
+
+			if not starts:
+				return False
+
+			index = bisect.bisect_right(starts, target) - 1
+
+			return index >= 0 and target in self.probed[port][index][0]
+
+	def get_protocol(self, target, port):
+		return self.answered[(target, port)][2]
+
+	def subset(self, ips):
+		# A copy with only the entries of the given addresses, to hand to a worker process
+		cache = ScanCache(self.path, self.ttl)
+		cache.now = self.now
+
+		# Shards are sorted, but lists of discovered IPv6 hosts are not contiguous
+		first, last = ips[0], ips[-1]
+
+		with self.lock:
+			cache.answered = {key: entry for key, entry in self.answered.items() if key[0] in ips}
+
+			for port, runs in self.probed.items():
+				cache.update_probed(port, [run for run in runs if run[0].stop > first and run[0].start <= last])
+
+		return cache
+
+	def add(self, probed, results, fingerprints):
+		# All probes in probed (address ranges per port) are done, the answered ones are in results
+		with self.lock:
+			for port, ranges in probed.items():
+				self.pending.setdefault(port, [ ]).extend(ranges)
+
+			for target, port, state in results:
+				self.answered[(target, port)] = (state, self.now, fingerprints.get(target, port) if fingerprints else None)
+
+	def merge(self, cache):
+		# Only the probes done by the worker are new, the rest are copies of our own
+		with self.lock:
+			for port, ranges in cache.pending.items():
+				self.pending.setdefault(port, [ ]).extend(ranges)
+
+			self.answered.update(cache.answered)
+
+
+class ScanCheckpoint:
+	# Remembers which probes of an unfinished scan are done, as address ranges per port,
+	# together with their answers, so that the next run can continue where this one stopped.
+	# Copies for worker processes have no path and are merged back by the main process.
+
+	def __init__(self, path, scan_id):
+		self.path = path
+		self.scan_id = scan_id
+		self.done = { }
+		self.starts = { }
+		self.results = { }
+		self.lock = threading.Lock()
+
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		del state["lock"]
+
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.lock = threading.Lock()
+
+	def load(self):
+		try:
+			with open(self.path, "r") as checkpoint_file:
+				data = json.load(checkpoint_file)
+
+			# Only a checkpoint of the very same scan can be resumed
+			if data.get("Scan") != self.scan_id or data.get("Saved", 0) < time.time() - CHECKPOINT_MAX_AGE:
+				return
+
+			for port, ranges in data["Done"].items():
+				self.set_done(int(port), [range(start, stop) for start, stop in ranges])
+
+			for key, (state, protocol) in data["Results"].items():
+				ip, _, port = key.rpartition(":")
+				self.results[(ip_to_int(ip), int(port))] = (state, protocol)
+		except (OSError, ValueError, TypeError, KeyError):
+			self.done = { }
+			self.starts = { }
+			self.results = { }
+
+	def save(self):
+		if not self.path:
+			return
+
+		with self.lock:
+			write_json_file(self.path, {
+				"Version": 1,
+				"Scan": self.scan_id,
+				"Saved": int(time.time()),
+				"Done": {str(port): [[r.start, r.stop] for r in ranges] for port, ranges in self.done.items()},
+				"Results": {int_to_ip(target) + ":" + str(port): [state, protocol] for (target, port), (state, protocol) in self.results.items()}
+			})
+
+	def delete(self):
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
+
+	def set_done(self, port, ranges):
+		self.done[port] = merge_ranges(ranges)
+		self.starts[port] = [r.start for r in self.done[port]]
+
+	def is_done(self, probe):
+		target, port = probe
+
+		# The ranges of a port are replaced while other ranges are being scanned
+		with self.lock:
+			starts = self.starts.get(port)
+
+			if not starts:
+				return False
+
+			index = bisect.bisect_right(starts, target) - 1
+
+			return index >= 0 and target in self.done[port][index]
+
+	def add(self, probed, results, fingerprints):
+		# All probes in probed (address ranges per port) are done, the answered ones are in results
+		with self.lock:
+			for port, ranges in probed.items():
+				self.set_done(port, self.done.get(port, [ ]) + ranges)
+
+			for target, port, state in results:
+				self.results[(target, port)] = (state, fingerprints.get(target, port) if fingerprints else None)
+
+	def get_results(self, ips):
+		with self.lock:
+			return {key: result for key, result in self.results.items() if key[0] in ips}
+
+	def subset(self, ips):
+		checkpoint = ScanCheckpoint(None, self.scan_id)
+		checkpoint.results = self.get_results(ips)
+
+		# Shards are sorted, but lists of discovered IPv6 hosts are not contiguous
+		first, last = ips[0], ips[-1]
+
+		for port, ranges in self.done.items():
+			checkpoint.set_done(port, [r for r in ranges if r.stop > first and r.start <= last])
+
+		return checkpoint
+
+	def merge(self, checkpoint):
+		with self.lock:
+			for port, ranges in checkpoint.done.items():
+				self.set_done(port, self.done.get(port, [ ]) + ranges)
+
+			self.results.update(checkpoint.results)
+
+
+def get_scan_id(ranges, ports, config):
+	# Identifies a scan by its configured ranges and ports. The IPv6 hosts discovered on top of
+	# them change between runs, but their probes are checkpointed by address like all others.
+	scan = [[[ips[0], ips[-1], len(ips)] for ips in ranges], ports, config["discovery"] and config["discovery_ports"], config["ipv6_discovery"]]
+
+	return hashlib.sha1(json.dumps(scan).encode()).hexdigest()
+
+
+class Fingerprints:
+	# Collects the protocols identified on open ports. Only ports in the given
+	# list are fingerprinted, everything else is just probed.
+
+	def __init__(self, ports):
+		self.ports = set(ports)
+		self.protocols = { }
+
+	def wants(self, port):
+		return port in self.ports
+
+	def get(self, target, port):
+		return self.protocols.get((target, port))
+
+	def set(self, target, port, protocol):
+		if protocol:
+			self.protocols[(target, port)] = protocol
+
+
+class NameCache:
+	# Remembers reverse DNS results, including failed lookups, until they expire
+
+	def __init__(self, path):
+		self.path = path
+		self.now = time.time()
+		self.entries = { }
+
+	def load(self):
+		try:
+			with open(self.path, "r") as cache_file:
+				data = json.load(cache_file)
+
+			for ip, (name, expires) in data.get("Entries", { }).items():
+				if expires > self.now:
+					self.entries[ip_to_int(ip)] = (name, expires)
+		except (OSError, ValueError, TypeError):
+			self.entries = { }
+
+	def save(self):
+		entries = {int_to_ip(address): [name, int(expires)] for address, (name, expires) in self.entries.items()}
+
+		write_json_file(self.path, { "Version": 1, "Entries": entries })
+
+	def __contains__(self, address):
+		return address in self.entries
+
+	def get(self, address):
+		return self.entries[address][0]
+
+	def set(self, address, name, ttl):
+		self.entries[address] = (name, self.now + ttl)
+
+
+def write_json_file(path, data):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+
+	# Write to a temporary file first so a cancelled reload never leaves a truncated file behind
+	temp_path = path + ".tmp"
+
+	with open(temp_path, "w") as json_file:
+		json.dump(data, json_file)
+
+	os.replace(temp_path, path)
+
+
+def get_cache_dir(config):
+	if config["cache_dir"]:
+		return config["cache_dir"]
+
+	if sys.platform == "win32":
+		base_dir = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+	elif sys.platform == "darwin":
+		base_dir = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+	else:
+		base_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+	return os.path.join(base_dir, "RoyalTS", "PortScan")
+
+
+def get_port_state(connect_result):
+	if connect_result == 0:
+		return PORT_OPEN
+
+	if connect_result in CONNECT_REFUSED:
+		return PORT_CLOSED
+
+	return None
+
 
-				connection = create_connection(object_type, name_postfix, target_to_scan, port_to_scan)
+@functools.lru_cache(maxsize=None)
+def get_client_hello():
+	# Let the ssl module produce a regular ClientHello without any actual connection
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	context.check_hostname = False
+	context.verify_mode = ssl.CERT_NONE
 
-				if ENABLE_LOGGING:
-					print("Found open port and created connection:")
-					print(connection)
+	outgoing = ssl.MemoryBIO()
+	tls = context.wrap_bio(ssl.MemoryBIO(), outgoing)
+
+	try:
+		tls.do_handshake()
+	except ssl.SSLWantReadError:
+		pass
+
+	return outgoing.read()
+
+
+def get_connection_request():
+	# An X.224 Connection Request in a TPKT header, asking for TLS or CredSSP security like mstsc does
+	negotiation_request = struct.pack("<BBHI", 0x01, 0, 8, 0x03)
+	connection_request = struct.pack(">BBHHB", 6 + len(negotiation_request), 0xE0, 0, 0, 0) + negotiation_request
+
+	return struct.pack(">BBH", 0x03, 0, 4 + len(connection_request)) + connection_request
+
+
+def classify_banner(data):
+	if data.startswith(b"SSH-"):
+		return "ssh"
+
+	if data.startswith(b"RFB "):
+		return "vnc"
+
+	if data.startswith(b"HTTP/"):
+		return "http"
+
+	# An X.224 Connection Confirm in a TPKT header in answer to the Connection Request
+	if len(data) >= 6 and data[0] == 0x03 and data[1] == 0x00 and data[5] & 0xF0 == 0xD0:
+		return "rdp"
+
+	# A TLS alert in answer to the Connection Request, or a handshake record (ServerHello) in answer to a ClientHello
+	if len(data) >= 2 and data[0] in (0x15, 0x16) and data[1] == 0x03:
+		return "https"
+
+	return None
+
+
+class FingerprintStage:
+	# Identifies the protocol spoken on already connected sockets without blocking, inside the
+	# selector loop of a scan engine: the engine adds the sockets, hands their events to on_event()
+	# and calls expire() whenever a deadline of the stage has passed. The protocols go to fingerprints.
+	#
+	# Server-first protocols (SSH, VNC) greet the client on their own. Sockets that stay silent
+	# get an X.224 Connection Request like an RDP client sends: RDP servers answer with a Connection
+	# Confirm, HTTP servers with an error response and TLS servers with an alert. Many TLS servers
+	# hang up instead; those get a TLS ClientHello on a new connection.
+
+	def __init__(self, selector, fingerprints):
+		self.selector = selector
+		self.fingerprints = fingerprints
+
+		# Maps each socket to its probe, its phase, the deadline of the phase and the peer address
+		self.sockets = { }
+
+	def add(self, sock, target, port):
+		sock.setblocking(False)
+		self.selector.register(sock, selectors.EVENT_READ, self)
+		self.sockets[sock] = [(target, port), "greeting", time.monotonic() + BANNER_TIMEOUT, None]
+
+	def next_deadline(self):
+		return min((state[2] for state in self.sockets.values()), default=math.inf)
+
+	def on_event(self, sock):
+		probe, phase, deadline, peer = self.sockets[sock]
+
+		if phase == "connecting":
+			if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+				self.finish(sock, None)
+				return
+
+			try:
+				sock.send(get_client_hello())
+			except OSError:
+				self.finish(sock, None)
+				return
+
+			self.selector.modify(sock, selectors.EVENT_READ, self)
+			self.sockets[sock][1] = "hello"
+			return
+
+		try:
+			data = sock.recv(64)
+		except OSError:
+			data = b""
+
+		if not data and phase == "request":
+			self.connect_tls(sock, probe, peer)
+		else:
+			self.finish(sock, classify_banner(data))
+
+	def expire(self):
+		now = time.monotonic()
+
+		for sock, (probe, phase, deadline, peer) in list(self.sockets.items()):
+			if deadline > now:
+				continue
+
+			if phase != "greeting":
+				self.finish(sock, None)
+				continue
+
+			try:
+				peer = (sock.family, sock.getpeername())
+				sock.send(get_connection_request())
+			except OSError:
+				self.finish(sock, None)
+				continue
+
+			self.sockets[sock][1:] = ["request", now + FINGERPRINT_TIMEOUT, peer]
+
+	def connect_tls(self, sock, probe, peer):
+		# The peer hung up on the Connection Request, the ClientHello gets a connection of its own
+		self.finish(sock, None, False)
+
+		family, address = peer
+
+		try:
+			sock = socket.socket(family, socket.SOCK_STREAM)
+		except OSError:
+			return
+
+		sock.setblocking(False)
+
+		if sock.connect_ex(address) not in CONNECT_IN_PROGRESS + (0,):
+			sock.close()
+			return
+
+		self.selector.register(sock, selectors.EVENT_WRITE, self)
+		self.sockets[sock] = [probe, "connecting", time.monotonic() + FINGERPRINT_TIMEOUT, peer]
+
+	def finish(self, sock, protocol, done=True):
+		probe = self.sockets.pop(sock)[0]
+		self.selector.unregister(sock)
+		sock.close()
+
+		if done:
+			self.fingerprints.set(*probe, protocol)
+
+	def close(self):
+		for sock in list(self.sockets):
+			self.finish(sock, None)
+
+
+def run_fingerprint_stage(stage, timeout=math.inf):
+	# Drives the stage on its own until all of its sockets are identified or the timeout has passed
+	deadline = time.monotonic() + timeout
+
+	while True:
+		stage.expire()
+		now = time.monotonic()
+
+		if not stage.sockets or now >= deadline:
+			break
+
+		for key, _ in stage.selector.select(max(0, min(deadline, stage.next_deadline()) - now)):
+			stage.on_event(key.fileobj)
+
+
+async def fingerprint_socket_async(sock):
+	loop = asyncio.get_running_loop()
+
+	try:
+		data = await asyncio.wait_for(loop.sock_recv(sock, 64), BANNER_TIMEOUT)
+	except asyncio.TimeoutError:
+		# See FingerprintStage
+		try:
+			peer = sock.getpeername()
+			await loop.sock_sendall(sock, get_connection_request())
+		except OSError:
+			return None
+
+		try:
+			data = await asyncio.wait_for(loop.sock_recv(sock, 64), FINGERPRINT_TIMEOUT)
+		except asyncio.TimeoutError:
+			return None
+		except OSError:
+			data = b""
+
+		if not data:
+			return await fingerprint_tls_async(sock.family, peer)
+	except OSError:
+		return None
+
+	return classify_banner(data)
+
+
+async def fingerprint_tls_async(family, address):
+	# See FingerprintStage.connect_tls()
+	loop = asyncio.get_running_loop()
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	sock.setblocking(False)
+
+	try:
+		await asyncio.wait_for(loop.sock_connect(sock, address), FINGERPRINT_TIMEOUT)
+		await loop.sock_sendall(sock, get_client_hello())
+		data = await asyncio.wait_for(loop.sock_recv(sock, 64), FINGERPRINT_TIMEOUT)
+	except (OSError, asyncio.TimeoutError):
+		return None
+	finally:
+		sock.close()
+
+	return classify_banner(data)
+
+
+def probe_port(target, port, timer, fingerprints=None, controller=None):
+	family, address = get_socket_address(target, port)
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	sock.settimeout(timer.timeout)
+
+	started = time.monotonic()
+	result = sock.connect_ex(address)
+
+	if result in RESOURCE_ERRORS:
+		sock.close()
+		raise OSError(result, os.strerror(result))
+
+	state = get_port_state(result)
+
+	if state:
+		timer.add_sample(time.monotonic() - started)
+
+		if controller:
+			controller.on_answer(target, port, time.monotonic() - started)
+	elif controller:
+		controller.on_timeout(target, port, started)
+
+	if state == PORT_OPEN and fingerprints and fingerprints.wants(port):
+		stage = FingerprintStage(selectors.DefaultSelector(), fingerprints)
+		stage.add(sock, target, port)
+
+		run_fingerprint_stage(stage)
+		stage.selector.close()
+
+	sock.close()
+
+	return state
+
+
+async def probe_port_async(target, port, timer, fingerprints=None, controller=None):
+	loop = asyncio.get_running_loop()
+
+	family, address = get_socket_address(target, port)
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	sock.setblocking(False)
+
+	started = time.monotonic()
+
+	try:
+		try:
+			await asyncio.wait_for(loop.sock_connect(sock, address), timer.timeout)
+		except ConnectionRefusedError:
+			timer.add_sample(time.monotonic() - started)
+
+			if controller:
+				controller.on_answer(target, port, time.monotonic() - started)
+
+			return PORT_CLOSED
+		except asyncio.TimeoutError:
+			if controller:
+				controller.on_timeout(target, port, started)
+
+			return None
+		except OSError as error:
+			if error.errno in RESOURCE_ERRORS:
+				raise
+
+			return None
+
+		timer.add_sample(time.monotonic() - started)
+
+		if controller:
+			controller.on_answer(target, port, time.monotonic() - started)
+
+		if fingerprints and fingerprints.wants(port):
+			fingerprints.set(target, port, await fingerprint_socket_async(sock))
+	finally:
+		sock.close()
+
+	return PORT_OPEN
+
+
+def scan_serial(probes, controller, timer, fingerprints=None):
+	results = [ ]
+
+	for target, port in probes:
+		if ENABLE_LOGGING:
+			print("Scanning " + int_to_ip(target) + ":" + str(port) + "...")
+
+		for attempt in range(RESOURCE_ERROR_RETRIES + 1):
+			time.sleep(controller.reserve(target))
+
+			try:
+				state = probe_port(target, port, timer, fingerprints, controller)
+				break
+			except OSError as error:
+				if error.errno not in RESOURCE_ERRORS or attempt == RESOURCE_ERROR_RETRIES:
+					raise
+
+				controller.on_resource_error()
+				time.sleep(RESOURCE_ERROR_BACKOFF)
+
+		if state:
+			results.append((target, port, state))
+
+	return results
+
+
+def probe_batch(batch, controller, timer, selector, stage=None):
+	# Start all connection attempts of the batch without blocking and wait for
+	# them in a single selector loop. The whole batch shares one deadline.
+	# Open sockets are handed to the fingerprint stage, whose sockets share the selector
+	# and are served by the same loop, also while later batches are being probed.
+	# Returns the results and the probes that could not be started for lack of resources;
+	# if not even the first probe could be started, the error is raised.
+	found = { }
+	retries = [ ]
+	connecting = { }
+
+	for index, (target, port) in enumerate(batch):
+		time.sleep(controller.reserve(target))
+
+		family, address = get_socket_address(target, port)
+
+		try:
+			sock = socket.socket(family, socket.SOCK_STREAM)
+		except OSError as error:
+			if error.errno not in RESOURCE_ERRORS or index == 0:
+				raise
+
+			controller.on_resource_error()
+			retries = batch[index:]
+			break
+
+		sock.setblocking(False)
+
+		started = time.monotonic()
+		result = sock.connect_ex(address)
+
+		if result in CONNECT_IN_PROGRESS:
+			selector.register(sock, selectors.EVENT_WRITE, (index, started))
+			connecting[sock] = (index, started)
+			continue
+
+		if result in RESOURCE_ERRORS:
+			sock.close()
+
+			if index == 0:
+				raise OSError(result, os.strerror(result))
+
+			controller.on_resource_error()
+			retries = batch[index:]
+			break
+
+		state = get_port_state(result)
+
+		if state:
+			found[index] = state
+			timer.add_sample(time.monotonic() - started)
+			controller.on_answer(target, port, time.monotonic() - started)
+
+		if state == PORT_OPEN and stage and stage.fingerprints.wants(port):
+			stage.add(sock, target, port)
+		else:
+			sock.close()
+
+	deadline = time.monotonic() + timer.timeout
+
+	while connecting:
+		now = time.monotonic()
+
+		if now >= deadline:
+			break
+
+		for key, _ in selector.select(max(0, min(deadline, stage.next_deadline() if stage else deadline) - now)):
+			if key.data is stage:
+				stage.on_event(key.fileobj)
+				continue
+
+			sock = key.fileobj
+			index, started = connecting.pop(sock)
+
+			# The socket becomes writable once the handshake either succeeded or failed
+			state = get_port_state(sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR))
+
+			if state:
+				found[index] = state
+				timer.add_sample(time.monotonic() - started)
+				controller.on_answer(*batch[index], time.monotonic() - started)
+
+			selector.unregister(sock)
+
+			if state == PORT_OPEN and stage and stage.fingerprints.wants(batch[index][1]):
+				stage.add(sock, *batch[index])
+			else:
+				sock.close()
+
+		if stage:
+			stage.expire()
+
+	for sock, (index, started) in connecting.items():
+		controller.on_timeout(*batch[index], started)
+		selector.unregister(sock)
+		sock.close()
+
+	return [batch[index] + (found[index],) for index in sorted(found)], retries
+
+
+def scan_selectors(probes, controller, timer, fingerprints=None):
+	# The batch size follows the concurrency controller. Probes to hosts that are not due
+	# yet (host spacing) and probes that could not be started for lack of resources are
+	# put in front of the next batch. Sockets that are still being fingerprinted count
+	# against the concurrency as well.
+	pending = iter(probes)
+	deferred = collections.deque()
+	results = [ ]
+
+	selector = selectors.DefaultSelector()
+	stage = FingerprintStage(selector, fingerprints) if fingerprints else None
+
+	try:
+		while True:
+			size = controller.concurrency - (len(stage.sockets) if stage else 0)
+
+			if size <= 0:
+				run_fingerprint_stage(stage, stage.next_deadline() - time.monotonic())
+				continue
+
+			batch = [ ]
+			skipped = [ ]
+			batch_targets = set()
+
+			while len(batch) < size and len(skipped) < controller.concurrency:
+				if deferred:
+					probe = deferred.popleft()
+				else:
+					probe = next(pending, None)
+
+					if probe is None:
+						break
+
+				if probe[0] in batch_targets or not controller.is_due(probe[0]):
+					skipped.append(probe)
+					continue
+
+				batch.append(probe)
+
+				if controller.host_spacing:
+					batch_targets.add(probe[0])
+
+			deferred.extendleft(reversed(skipped))
+
+			if not batch:
+				if not deferred:
+					break
+
+				due = time.monotonic() + controller.get_wait(target for target, port in deferred)
+
+				if stage:
+					run_fingerprint_stage(stage, due - time.monotonic())
+
+				time.sleep(max(0, due - time.monotonic()))
+				continue
+
+			if ENABLE_LOGGING:
+				print("Scanning batch of " + str(len(batch)) + " ports...")
+
+			batch_results, retries = probe_batch(batch, controller, timer, selector, stage)
+			results.extend(batch_results)
+
+			deferred.extendleft(reversed(retries))
+
+		if stage:
+			run_fingerprint_stage(stage)
+	finally:
+		if stage:
+			stage.close()
+
+		selector.close()
+
+	return results
+
+
+async def scan_asyncio(probes, controller, timer, fingerprints=None):
+	# A pool of workers pulls from one shared iterator. Workers only start a connection
+	# attempt while fewer than controller.concurrency attempts are in flight.
+	pending = iter(enumerate(probes))
+	found = [ ]
+	slots = asyncio.Condition()
+	in_flight = 0
+
+	async def acquire():
+		nonlocal in_flight
+
+		async with slots:
+			await slots.wait_for(lambda: in_flight < controller.concurrency)
+			in_flight += 1
+
+	async def release():
+		nonlocal in_flight
+
+		async with slots:
+			in_flight -= 1
+			slots.notify(controller.concurrency - in_flight)
+
+	async def worker():
+		for index, (target, port) in pending:
+			for attempt in range(RESOURCE_ERROR_RETRIES + 1):
+				await acquire()
+
+				try:
+					await asyncio.sleep(controller.reserve(target))
+					state = await probe_port_async(target, port, timer, fingerprints, controller)
+					break
+				except OSError as error:
+					if error.errno not in RESOURCE_ERRORS or attempt == RESOURCE_ERROR_RETRIES:
+						raise
+
+					controller.on_resource_error()
+				finally:
+					await release()
+
+				# Give the sockets in flight a moment to finish before trying again
+				await asyncio.sleep(RESOURCE_ERROR_BACKOFF)
+
+			if state:
+				found.append((index, target, port, state))
+
+	await asyncio.gather(*[worker() for _ in range(controller.max_concurrency)])
+
+	# Results arrive in completion order; restore the order of the probe list
+	return [(target, port, state) for index, target, port, state in sorted(found)]
+
+
+def get_max_open_files(requested):
+	# Every in-flight probe holds a file descriptor. Raise the soft limit as far as
+	# the hard limit allows and keep some headroom for the interpreter itself.
+	try:
+		import resource
+	except ImportError:
+		return requested
+
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+	if soft != resource.RLIM_INFINITY and soft < requested + 64:
+		wanted = requested + 64
+
+		if hard != resource.RLIM_INFINITY:
+			wanted = min(wanted, hard)
+
+		try:
+			resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+			soft = wanted
+		except (ValueError, OSError):
+			pass
+
+	if soft == resource.RLIM_INFINITY:
+		return requested
+
+	return max(1, min(requested, soft - 64))
+
+
+def get_concurrency_controller(config, timer, bucket=None):
+	engine = config["engine"]
+	max_concurrency = get_max_open_files(config["max_concurrency"])
+
+	if engine == "serial":
+		max_concurrency = 1
+
+	# select() on Windows cannot wait for more than 512 sockets at once
+	if engine == "selectors" and sys.platform == "win32":
+		max_concurrency = min(max_concurrency, 500)
+
+	return ConcurrencyController(max_concurrency, timer, config["adaptive_concurrency"], bucket, config["host_spacing"])
+
+
+def scan(probes, config, timer, fingerprints=None, controller=None):
+	engine = config["engine"]
+
+	if not controller:
+		controller = get_concurrency_controller(config, timer)
+
+	if engine == "serial":
+		return scan_serial(probes, controller, timer, fingerprints)
+
+	if engine == "asyncio":
+		return asyncio.run(scan_asyncio(probes, controller, timer, fingerprints))
+
+	if engine == "selectors":
+		return scan_selectors(probes, controller, timer, fingerprints)
+
+	raise ValueError("Unknown scan engine: " + engine)
+
+
+def read_neighbour_table():
+	# Hosts the kernel has recently resolved on the local link are known to be alive.
+	# Returns their MAC addresses by address. Only available on Linux; other platforms
+	# simply start without any neighbours.
+	neighbours = { }
+
+	try:
+		with open("/proc/net/arp") as arp_table:
+			next(arp_table, None)
+
+			for line in arp_table:
+				fields = line.split()
+
+				# Flags 0x0 mark incomplete entries, i.e. the address did not answer
+				if len(fields) >= 4 and int(fields[2], 16) != 0 and fields[3] != "00:00:00:00:00:00":
+					neighbours[ip_to_int(fields[0])] = fields[3].lower()
+	except (OSError, ValueError):
+		pass
+
+	return neighbours
+
+
+def read_ipv6_neighbour_table(interfaces=None):
+	# Dumps the kernel's IPv6 neighbour cache over netlink, optionally only of the given interfaces.
+	# Returns the MAC addresses by address, without multicast addresses and failed resolutions.
+	neighbours = { }
+
+	try:
+		with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+			sock.settimeout(SOCKET_TIMEOUT)
+			sock.send(struct.pack("=LHHLL", 28, RTM_GETNEIGH, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + struct.pack("=BxxxiHBB", socket.AF_INET6, 0, 0, 0, 0))
+
+			done = False
+
+			while not done:
+				data = sock.recv(65536)
+				offset = 0
+
+				while offset + 16 <= len(data):
+					length, message_type = struct.unpack_from("=LH", data, offset)
+
+					if length < 16 or message_type in (NLMSG_DONE, NLMSG_ERROR):
+						done = True
+						break
+
+					if message_type == RTM_NEWNEIGH:
+						family, ifindex, state = struct.unpack_from("=BxxxiH", data, offset + 16)
+						address, mac = None, None
+						attribute = offset + 28
+
+						# Attributes are padded to multiples of four bytes
+						while attribute + 4 <= offset + length:
+							attribute_length, attribute_type = struct.unpack_from("=HH", data, attribute)
+
+							if attribute_length < 4:
+								break
+
+							if attribute_type == NDA_DST:
+								address = data[attribute + 4:attribute + attribute_length]
+							elif attribute_type == NDA_LLADDR:
+								mac = data[attribute + 4:attribute + attribute_length]
+
+							attribute += (attribute_length + 3) & ~3
+
+						usable = family == socket.AF_INET6 and address and mac and address[0] != 0xFF and not state & (NUD_INCOMPLETE | NUD_FAILED | NUD_NOARP)
+
+						if usable and (interfaces is None or ifindex in interfaces):
+							neighbours[get_ipv6_target(address, ifindex)] = mac.hex(":")
+
+					offset += (length + 3) & ~3
+	except (OSError, AttributeError, struct.error):
+		# AF_NETLINK only exists on Linux
+		pass
+
+	return neighbours
+
+
+def get_default_interface_ipv6():
+	# The IPv6 default route is ::/0; interfaces without one fall back to the IPv4 default route
+	default_routes = [ ]
+
+	try:
+		with open("/proc/net/ipv6_route") as route_table:
+			for line in route_table:
+				fields = line.split()
+
+				if len(fields) < 10 or fields[0] != "0" * 32 or fields[1] != "00" or fields[9] == "lo":
+					continue
+
+				flags = int(fields[8], 16)
+
+				if flags & RTF_UP and not flags & RTF_REJECT:
+					default_routes.append((int(fields[5], 16), fields[9]))
+	except (OSError, ValueError):
+		pass
+
+	return min(default_routes)[1] if default_routes else get_default_interface_linux()
+
+
+def ping_all_nodes(interfaces):
+	# Sends an ICMPv6 echo request to the all-nodes multicast address (ff02::1) on every interface
+	# and returns the hosts that answered. Prefers unprivileged ping sockets over raw sockets.
+	try:
+		sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_ICMPV6)
+	except OSError:
+		try:
+			sock = socket.socket(socket.AF_INET6, socket.SOCK_RAW, socket.IPPROTO_ICMPV6)
+		except OSError:
+			# Neither is permitted; the neighbour table is all there is
+			return set()
+
+	identifier = os.getpid() & 0xFFFF
+	responders = set()
+
+	with sock:
+		for ifindex in interfaces:
+			try:
+				sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, ifindex)
+				sock.sendto(struct.pack("!BBHHH", 128, 0, 0, identifier, 1), ("ff02::1", 0, 0, ifindex))
+			except OSError:
+				continue
+
+		deadline = time.monotonic() + IPV6_DISCOVERY_TIMEOUT
+
+		while True:
+			remaining = deadline - time.monotonic()
+
+			if remaining <= 0:
+				break
+
+			sock.settimeout(remaining)
+
+			try:
+				data, address = sock.recvfrom(1024)
+			except OSError:
+				break
+
+			# Raw sockets see every ICMPv6 message; ping sockets only the replies to their own requests
+			if len(data) < 8 or data[0] != 129 or (sock.type == socket.SOCK_RAW and struct.unpack("!H", data[4:6])[0] != identifier):
+				continue
+
+			responders.add(get_ipv6_target(socket.inet_pton(socket.AF_INET6, address[0].partition("%")[0]), address[3]))
+
+	return responders
+
+
+def discover_ipv6_hosts(mode, excluded_ranges):
+	# IPv6 subnets can't be scanned address by address. Instead, the hosts on the selected
+	# interfaces are asked to answer a multicast ping, and the kernel's neighbour cache adds
+	# every host that was seen recently. Returns the sorted targets, without our own addresses.
+	if not sys.platform.startswith("linux"):
+		raise ValueError("IPv6 discovery is only supported on Linux")
+
+	interfaces = { }
+	own_addresses = set()
+
+	try:
+		with open("/proc/net/if_inet6") as address_table:
+			for line in address_table:
+				fields = line.split()
+
+				if len(fields) < 6:
+					continue
+
+				own_addresses.add(int(fields[0], 16))
+
+				if fields[5] != "lo":
+					interfaces[int(fields[1], 16)] = fields[5]
+	except (OSError, ValueError):
+		# IPv6 is disabled
+		return [ ]
+
+	if mode == "none":
+		interfaces = { }
+	elif mode != "all":
+		default_interface = get_default_interface_ipv6()
+		interfaces = {ifindex: iface_name for ifindex, iface_name in interfaces.items() if iface_name == default_interface}
+
+	# The ping fills the neighbour cache as well, so it is read afterwards
+	hosts = ping_all_nodes(interfaces)
+	hosts.update(read_ipv6_neighbour_table(interfaces))
+
+	return sorted(target for target in hosts if target & IPV6_ADDRESS_MASK not in own_addresses and not any(target in r for r in excluded_ranges))
+
+
+def remove_dual_stack_duplicates(results):
+	# A service that is open on both the IPv4 and the IPv6 address of a host is only reported
+	# with its IPv4 address. Both addresses belong to the same host if they resolve to the same MAC address.
+	ipv4_neighbours = read_neighbour_table()
+	ipv6_neighbours = read_ipv6_neighbour_table()
+
+	ipv4_services = set((ipv4_neighbours[target], port) for target, port, state in results if state == PORT_OPEN and target in ipv4_neighbours)
+
+	return [result for result in results if not is_ipv6(result[0]) or (ipv6_neighbours.get(result[0]), result[1]) not in ipv4_services]
+
+
+def scatter(count):
+	# Yields every number below count exactly once, in a scattered order and without building
+	# a list: stepping by any number coprime to count visits each index once, and a step near
+	# count / phi keeps consecutive indices far apart
+	if count == 0:
+		return
+
+	step = int(count * 0.618) + random.randrange(max(1, count // 16))
+
+	while math.gcd(step, count) != 1:
+		step += 1
+
+	start = random.randrange(count)
+
+	for i in range(count):
+		yield (start + i * step) % count
+
+
+def get_probes(targets, ports, order, skipped=()):
+	# "host" probes all ports of a host before moving on to the next host, "port" probes one
+	# port on every host before moving on to the next port and "random" scatters the probes.
+	# targets has to be a sequence, e.g. a range or a list. Targets in skipped are left out
+	# without copying the others, only "random" needs a list of the remaining ones to index.
+	if order == "host":
+		return ((target, port) for target in targets if target not in skipped for port in ports)
+
+	if order == "port":
+		return ((target, port) for port in ports for target in targets if target not in skipped)
+
+	if order == "random":
+		if skipped:
+			targets = [target for target in targets if target not in skipped]
+
+		return ((targets[index % len(targets)], ports[index // len(targets)]) for index in scatter(len(targets) * len(ports)))
+
+	raise ValueError("Unknown probe order: " + order)
+
+
+class ProbeFeed:
+	# Hands out the probes in slices that end at a given time, so that the scan can stop
+	# in between for a checkpoint or at the deadline. With record set, it marks the probes
+	# of the last slice in a bitmap per port and block of addresses, which take one bit per
+	# address no matter in which order the probes come.
+
+	def __init__(self, probes, record=False):
+		self.probes = iter(probes)
+		self.record = record
+		self.blocks = { }
+		self.exhausted = False
+
+	def until(self, end):
+		self.blocks = { }
+
+		for probe in self.probes:
+			if self.record:
+				self.add_issued(*probe)
+
+			yield probe
+
+			if time.time() >= end:
+				return
+
+		self.exhausted = True
+
+	def add_issued(self, target, port):
+		key = (port, target >> PROBE_BLOCK_BITS)
+		bits = self.blocks.get(key)
+
+		if bits is None:
+			bits = self.blocks[key] = bytearray(1 << PROBE_BLOCK_BITS >> 3)
+
+		offset = target & ((1 << PROBE_BLOCK_BITS) - 1)
+		bits[offset >> 3] |= 1 << (offset & 7)
+
+	def get_issued(self):
+		# The probes of the last slice as sorted address ranges per port
+		issued = { }
+
+		for (port, block), bits in sorted(self.blocks.items()):
+			runs = issued.setdefault(port, [ ])
+			value = int.from_bytes(bits, "little")
+			start = block << PROBE_BLOCK_BITS
+
+			while value:
+				# Skip the trailing zeros, then take the trailing ones as one range
+				zeros = (value & -value).bit_length() - 1
+				value >>= zeros
+				start += zeros
+
+				ones = (~value & (value + 1)).bit_length() - 1
+				value >>= ones
+
+				if runs and runs[-1].stop == start:
+					runs[-1] = range(runs[-1].start, start + ones)
+				else:
+					runs.append(range(start, start + ones))
+
+				start += ones
+
+		return issued
+
+
+def run_scan(probes, config, timer, controller, stats, cache, fingerprints, checkpoint):
+	# All probes of a slice are done when scan() returns, so the results are saved in between
+	feed = ProbeFeed(probes, bool(cache or checkpoint))
+	results = [ ]
+
+	while not feed.exhausted:
+		now = time.time()
+		end = config["deadline_at"] or math.inf
+
+		if now >= end:
+			break
+
+		if checkpoint:
+			end = min(end, now + CHECKPOINT_INTERVAL)
+
+		slice_results = scan(count_probes(feed.until(end), stats), config, timer, fingerprints, controller)
+		results.extend(slice_results)
+
+		if cache or checkpoint:
+			issued = feed.get_issued()
+
+		if cache:
+			cache.add(issued, slice_results, fingerprints)
+
+		if checkpoint:
+			checkpoint.add(issued, slice_results, fingerprints)
+			checkpoint.save()
+
+	return results
+
+
+def count_probes(probes, stats):
+	# Counts the probes handed to the scan engine
+	for probe in probes:
+		stats["probes"] += 1
+
+		yield probe
+
+
+def discover_hosts(ips, config, timer, controller, stats, cache, cached, fingerprints, checkpoint):
+	# A host is considered alive if it is in the neighbour table or if any of the
+	# discovery ports either accepts or actively refuses a connection.
+	discovery_ports = config["discovery_ports"]
+
+	neighbours = read_neighbour_table()
+	live_hosts = set(target for target in neighbours if target in ips)
+	seeded = len(live_hosts)
+
+	# Hosts that answered on any port within the cache TTL are known to be alive as well
+	live_hosts.update(target for target, port in cached)
+
+	probes = (probe for probe in get_probes(ips, discovery_ports, config["probe_order"], live_hosts) if probe not in cached and not (cache and cache.is_fresh(probe)) and not (checkpoint and checkpoint.is_done(probe)))
+	results = run_scan(probes, config, timer, controller, stats, cache, fingerprints, checkpoint)
+
+	live_hosts.update(target for target, port, state in results)
+
+	if ENABLE_LOGGING:
+		print("Discovered " + str(len(live_hosts)) + " live hosts (" + str(seeded) + " from the neighbour table)")
+
+	return sorted(live_hosts), results
+
+
+def resolve_names(addresses, budget):
+	# Looks up the PTR names of the given addresses on a bounded number of threads.
+	# Returns whatever was resolved within the budget; addresses without an answer are
+	# missing from the result, failed lookups map to None.
+	names = { }
+	done = queue.Queue()
+
+	def lookup(address):
+		try:
+			name = socket.gethostbyaddr(int_to_ip(address))[0]
+		except (OSError, UnicodeError):
+			name = None
+
+		done.put((address, name))
+
+	pending = list(addresses)
+	in_flight = { }
+	deadline = time.monotonic() + budget
+
+	while pending or in_flight:
+		now = time.monotonic()
+
+		if now >= deadline:
+			break
+
+		# The resolver can't be interrupted, so lookups over the timeout are just abandoned.
+		# They run on daemon threads and never hold up the script.
+		for address, started in list(in_flight.items()):
+			if now - started >= DNS_LOOKUP_TIMEOUT:
+				del in_flight[address]
+
+		while pending and len(in_flight) < DNS_WORKERS:
+			address = pending.pop()
+			in_flight[address] = now
+
+			threading.Thread(target=lookup, args=(address,), daemon=True).start()
+
+		if not in_flight:
+			continue
+
+		wait = min(deadline, min(in_flight.values()) + DNS_LOOKUP_TIMEOUT) - now
+
+		try:
+			address, name = done.get(timeout=max(0, wait))
+		except queue.Empty:
+			continue
+
+		if address in in_flight:
+			del in_flight[address]
+			names[address] = name
+
+	return names
+
+
+def get_host_names(addresses, config):
+	cache = None
+	names = { }
+
+	if config["dns_cache_ttl"] > 0:
+		cache = NameCache(os.path.join(get_cache_dir(config), "dns-cache.json"))
+		cache.load()
+
+		for address in addresses:
+			if address in cache:
+				names[address] = cache.get(address)
+
+	resolved = resolve_names([address for address in addresses if address not in names], config["dns_budget"])
+
+	if cache:
+		for address, name in resolved.items():
+			cache.set(address, name, config["dns_cache_ttl"] if name else DNS_NEGATIVE_CACHE_TTL)
+
+		cache.save()
+
+	names.update(resolved)
+
+	if ENABLE_LOGGING:
+		print("Resolved " + str(len(resolved)) + " of " + str(len(addresses)) + " host names (" + str(len(addresses) - len(resolved)) + " cached or timed out)")
+
+	return names
+
+
+def create_connection(object_type, name_postfix, host, port, host_name=None):
+	name = host_name or host
+
+	if name_postfix:
+		name += name_postfix
+
+	connection = {
+		"Type": object_type,
+		"Name": name,
+		"ComputerName": host,
+		"Port": port,
+		"Path": "/" + (host_name or host)
+	}
+
+	return connection
+
+
+def parse_potential_string_bool(potential_bool):
+	actual_bool = False
+	
+	if isinstance(potential_bool, bool):
+		actual_bool = potential_bool
+	elif isinstance(potential_bool, str):
+		potential_bool = potential_bool.lower()
+		if potential_bool == "true" or potential_bool == "yes":
+			actual_bool = True
+
+	return actual_bool
+
+
+def parse_potential_string_int(potential_int, default):
+	try:
+		return int(str(potential_int).strip())
+	except ValueError:
+		return default
+
+
+def parse_potential_string_float(potential_float, default):
+	try:
+		return float(str(potential_float).strip())
+	except ValueError:
+		return default
+
+
+def parse_potential_string_workers(potential_workers):
+	# "auto" starts one worker process per CPU, 0 scans in the main process
+	if str(potential_workers).strip().lower() == "auto":
+		return os.cpu_count() or 1
+
+	return max(0, parse_potential_string_int(potential_workers, 0))
+
+
+def parse_potential_string_list(potential_list):
+	return str(potential_list).replace(",", " ").replace(";", " ").split()
+
+
+def parse_potential_string_port_list(potential_list, default):
+	ports = [ ]
+
+	for value in parse_potential_string_list(potential_list):
+		port = parse_potential_string_int(value, 0)
+
+		if 0 < port < 65536 and port not in ports:
+			ports.append(port)
+
+	return ports or default
+
+
+def print_diagnostics(diagnostics):
+	# stdout is reserved for the RoyalJSON document. Ranges are scanned in parallel,
+	# so each block is written with a single call to keep it together.
+	lines = [key + ": " + str(value) for key, value in diagnostics.items()]
+
+	print("\n".join(lines), file=sys.stderr)
+
+
+def get_ports_to_scan(config):
+	ports = [ ]
+
+	for port_to_scan in PORT_MAPPINGS.keys():
+		if port_to_scan == 22 and not config["ssh"]:
+			continue
+
+		if port_to_scan == 3389 and not config["rdp"]:
+			continue
+
+		if port_to_scan == 5900 and not config["vnc"]:
+			continue
+
+		if port_to_scan == 80 and not config["http"]:
+			continue
+
+		if port_to_scan == 443 and not config["https"]:
+			continue
+
+		ports.append(port_to_scan)
+
+	if config["fingerprint"]:
+		for port_to_scan in config["fingerprint_ports"]:
+			if port_to_scan not in ports:
+				ports.append(port_to_scan)
+
+	return ports
+
+
+def scan_range(ips, ports, config, cache, fingerprints, bucket, checkpoint):
+	results = [ ]
+
+	timer = AdaptiveTimeout(SOCKET_TIMEOUT, config["adaptive_timeout"])
+	controller = get_concurrency_controller(config, timer, bucket)
+	stats = { "probes": 0 }
+	started = time.monotonic()
+
+	cached = cache.get_fresh(ips) if cache else { }
+	protocols = { }
+
+	# Answers from the checkpoint of an interrupted run are used just like cached ones
+	resumed = checkpoint.get_results(ips) if checkpoint else { }
+
+	for key, (state, protocol) in resumed.items():
+		cached[key] = state
+		protocols[key] = protocol
+
+	# Discovered IPv6 hosts answered already, so only IPv4 ranges need host discovery
+	if config["discovery"] and not is_ipv6(ips[0]):
+		live_hosts, discovery_results = discover_hosts(ips, config, timer, controller, stats, cache, cached, fingerprints, checkpoint)
+
+		# Answers to discovery probes on one of the scanned ports don't need to be probed again
+		results = [result for result in discovery_results if result[1] in ports]
+	else:
+		live_hosts = ips
+
+	answered = set((target, port) for target, port, state in results)
+	probes = (probe for probe in get_probes(live_hosts, ports, config["probe_order"]) if probe not in answered and probe not in cached and not (cache and cache.is_fresh(probe)) and not (checkpoint and checkpoint.is_done(probe)))
+
+	results.extend(run_scan(probes, config, timer, controller, stats, cache, fingerprints, checkpoint))
+
+	for (target, port), state in cached.items():
+		if port not in ports:
+			continue
+
+		results.append((target, port, state))
+
+		if fingerprints:
+			fingerprints.set(target, port, protocols[(target, port)] if (target, port) in protocols else cache.get_protocol(target, port))
+
+	if config["diagnostics"]:
+		if timer.count:
+			timer.update()
+
+		print_diagnostics({
+			"Subnet": int_to_ip(ips[0]) + " - " + int_to_ip(ips[-1]),
+			"Scan engine": config["engine"],
+			"Probes": stats["probes"],
+			"Cached probes": len(cached) - len(resumed),
+			"Resumed probes": len(resumed),
+			"Answered probes": len(results),
+			"Open ports": sum(1 for result in results if result[2] == PORT_OPEN),
+			"Duration (s)": round(time.monotonic() - started, 3),
+			"RTT p99 (ms)": round(timer.p99 * 1000, 2) if timer.p99 is not None else "n/a",
+			"Timeout (s)": round(timer.timeout, 3),
+			"Timeout upper bound (s)": SOCKET_TIMEOUT,
+			"Concurrency (final / max)": str(controller.concurrency) + " / " + str(controller.max_concurrency),
+			"Throttling events": controller.throttles,
+			"Rate limit (probes/s)": config["max_rate"] or "none"
+		})
+
+	return results
+
+
+def get_shards(ranges, shard_size):
+	shards = [ ]
+
+	for ips in ranges:
+		shards.extend(ips[start:start + shard_size] for start in range(0, len(ips), shard_size))
+
+	return shards
+
+
+def scan_shard(ips, ports, config, cache, checkpoint):
+	# Runs in a worker process, which can't share objects with the main process. The shard works
+	# on its own copies of the cache and the checkpoint and returns them with the results.
+	fingerprints = Fingerprints(ports) if config["fingerprint"] else None
+	bucket = TokenBucket(config["max_rate"]) if config["max_rate"] > 0 else None
+
+	results = scan_range(ips, ports, config, cache, fingerprints, bucket, checkpoint)
+
+	return results, cache, fingerprints.protocols if fingerprints else { }, checkpoint
+
+
+def scan_shards(ranges, ports, config, cache, fingerprints, checkpoint):
+	workers = config["workers"]
+
+	# ProcessPoolExecutor on Windows doesn't support more than 61 workers
+	if sys.platform == "win32":
+		workers = min(workers, 61)
+
+	shards = get_shards(ranges, config["shard_size"])
+	workers = min(workers, len(shards))
+
+	# The workers run at the same time and share the concurrency and rate budgets
+	max_concurrency = get_max_open_files(config["max_concurrency"])
+	shard_config = dict(config, max_concurrency=max(1, max_concurrency // workers), max_rate=config["max_rate"] / workers)
+
+	results = [ ]
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(scan_shard, ips, ports, shard_config, cache.subset(ips) if cache else None, checkpoint.subset(ips) if checkpoint else None) for ips in shards]
+
+		for future in futures:
+			shard_results, shard_cache, protocols, shard_checkpoint = future.result()
+			results.extend(shard_results)
+
+			if cache:
+				cache.merge(shard_cache)
+
+			if fingerprints:
+				fingerprints.protocols.update(protocols)
+
+			# Progress is saved as the shards finish
+			if checkpoint:
+				checkpoint.merge(shard_checkpoint)
+				checkpoint.save()
+
+	return results
+
+
+def get_connections(config):
+	ranges = get_ranges_to_scan(config)
+	ports = get_ports_to_scan(config)
+	scan_id = get_scan_id(ranges, ports, config)
+
+	# The discovered IPv6 hosts are scanned as one more "range"
+	ipv6_hosts = [ ]
+
+	if config["ipv6_discovery"]:
+		try:
+			ipv6_hosts = discover_ipv6_hosts(config["interfaces"], merge_ranges(get_cidr_range(cidr, False) for cidr in config["exclude"]))
+		except ValueError as error:
+			# Not worth failing the whole scan for, the other ranges are scanned as usual
+			print(str(error) + ", the IPv6 hosts are not discovered", file=sys.stderr)
+
+		if ipv6_hosts:
+			ranges.append(ipv6_hosts)
+
+		if config["diagnostics"]:
+			print_diagnostics({ "Discovered IPv6 hosts": len(ipv6_hosts) })
+
+	results = [ ]
+	cache = None
+	fingerprints = Fingerprints(ports) if config["fingerprint"] else None
+	bucket = TokenBucket(config["max_rate"]) if config["max_rate"] > 0 else None
+
+	checkpoint = None
+
+	# The deadline is a wall clock time, which is the same in worker processes
+	config = dict(config, deadline_at=time.time() + config["deadline"] if config["deadline"] > 0 else None)
+
+	if config["cache_ttl"] > 0:
+		cache = ScanCache(os.path.join(get_cache_dir(config), "scan-cache.json"), config["cache_ttl"])
+
+		if not config["full_rescan"]:
+			cache.load()
+
+	if config["resume"]:
+		checkpoint = ScanCheckpoint(os.path.join(get_cache_dir(config), "checkpoint.json"), scan_id)
+		checkpoint.load()
+
+	if ranges and ports and config["workers"] > 0:
+		results = scan_shards(ranges, ports, config, cache, fingerprints, checkpoint)
+	elif ranges and ports:
+		# Independent ranges are scanned at the same time and share the concurrency budget by
+		# their sizes, so that a single host doesn't get as many sockets as a whole subnet
+		max_concurrency = get_max_open_files(config["max_concurrency"])
+		total_size = sum(len(ips) for ips in ranges)
+		range_configs = [dict(config, max_concurrency=max(1, max_concurrency * len(ips) // total_size)) for ips in ranges]
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+			for range_results in executor.map(lambda ips, range_config: scan_range(ips, ports, range_config, cache, fingerprints, bucket, checkpoint), ranges, range_configs):
+				results.extend(range_results)
+
+	if cache:
+		cache.save()
+
+	interrupted = config["deadline_at"] is not None and time.time() >= config["deadline_at"]
+
+	# A finished scan starts from scratch next time; an interrupted one is continued
+	if checkpoint and not interrupted:
+		checkpoint.delete()
+
+	if interrupted and config["diagnostics"]:
+		print_diagnostics({ "Deadline reached": "the results may be incomplete" + (", the scan continues on the next reload" if checkpoint else "") })
+
+	if bucket and config["diagnostics"]:
+		print_diagnostics({ "Rate limited probes": bucket.delayed })
+
+	if ipv6_hosts:
+		results = remove_dual_stack_duplicates(results)
+
+	results.sort(key=lambda result: (result[0], ports.index(result[1])))
+
+	host_names = { }
+
+	if config["reverse_dns"]:
+		host_names = get_host_names(sorted(set(target for target, port, state in results if state == PORT_OPEN)), config)
+
+	connections = [ ]
+
+	for target, port, state in results:
+		if state != PORT_OPEN:
+			continue
+
+		protocol = fingerprints.get(target, port) if fingerprints else None
+
+		if protocol:
+			# Skip services whose connection type is disabled, wherever they were found
+			if not config[protocol]:
+				continue
+
+			props = PROTOCOL_MAPPINGS[protocol]
+		elif port in PORT_MAPPINGS:
+			props = PORT_MAPPINGS[port]
+		else:
+			# Nothing recognizable on one of the additional fingerprint ports
+			continue
+
+		object_type = props["Type"]
+		name_postfix = props["NamePostfix"]
+
+		connection = create_connection(object_type, name_postfix, int_to_ip(target), port, host_names.get(target))
+
+		if ENABLE_LOGGING:
+			print("Found open port and created connection:")
+			print(connection)
 
-				connections.append(connection)
+		connections.append(connection)
 
 	store = {
 		"Objects": connections
@@ -169,7 +2354,35 @@ config = {
 	"rdp": parse_potential_string_bool("$CustomProperty.RDP$"),
 	"vnc": parse_potential_string_bool("$CustomProperty.VNC$"),
 	"http": parse_potential_string_bool("$CustomProperty.HTTP$"),
-	"https": parse_potential_string_bool("$CustomProperty.HTTPS$")
+	"https": parse_potential_string_bool("$CustomProperty.HTTPS$"),
+	"engine": "$CustomProperty.ScanEngine$".strip().lower() or "asyncio",
+	"max_concurrency": max(1, parse_potential_string_int("$CustomProperty.MaxConcurrency$", 512)),
+	"adaptive_concurrency": parse_potential_string_bool("$CustomProperty.AdaptiveConcurrency$"),
+	"max_rate": max(0, parse_potential_string_int("$CustomProperty.MaxProbesPerSecond$", 0)),
+	"workers": parse_potential_string_workers("$CustomProperty.WorkerProcesses$"),
+	"shard_size": max(1, parse_potential_string_int("$CustomProperty.ShardSize$", 4096)),
+	"probe_order": "$CustomProperty.ProbeOrder$".strip().lower() or "port",
+	"host_spacing": max(0, parse_potential_string_int("$CustomProperty.HostSpacing$", 0)) / 1000,
+	"resume": parse_potential_string_bool("$CustomProperty.ResumeScans$"),
+	"deadline": max(0, parse_potential_string_float("$CustomProperty.Deadline$", 0)),
+	"discovery": parse_potential_string_bool("$CustomProperty.HostDiscovery$"),
+	"discovery_ports": parse_potential_string_port_list("$CustomProperty.DiscoveryPorts$", [22, 80, 443, 445, 3389]),
+	"ipv6_discovery": parse_potential_string_bool("$CustomProperty.IPv6Discovery$"),
+	"adaptive_timeout": parse_potential_string_bool("$CustomProperty.AdaptiveTimeout$"),
+	"diagnostics": parse_potential_string_bool("$CustomProperty.Diagnostics$"),
+	"interfaces": "$CustomProperty.Interfaces$".strip().lower() or "default",
+	"include": parse_potential_string_list("$CustomProperty.IncludeSubnets$"),
+	"exclude": parse_potential_string_list("$CustomProperty.ExcludeSubnets$"),
+	"cache_ttl": max(0, parse_potential_string_int("$CustomProperty.CacheTTL$", 0)) * 60,
+	"full_rescan": parse_potential_string_bool("$CustomProperty.FullRescan$"),
+	"cache_dir": "$CustomProperty.CacheDirectory$".strip(),
+	"fingerprint": parse_potential_string_bool("$CustomProperty.Fingerprint$"),
+	"fingerprint_ports": parse_potential_string_port_list("$CustomProperty.FingerprintPorts$", [ ]),
+	"reverse_dns": parse_potential_string_bool("$CustomProperty.ReverseDNS$"),
+	"dns_budget": max(0, parse_potential_string_float("$CustomProperty.DNSBudget$", 5.0)),
+	"dns_cache_ttl": max(0, parse_potential_string_int("$CustomProperty.DNSCacheTTL$", 1440)) * 60
 }
 
-print(get_connections(config))
\ No newline at end of file
+# Worker processes import this script as a module on platforms that don't fork
+if __name__ == "__main__":
+	print(get_connections(config))
\ No newline at end of file